@@ -0,0 +1,245 @@
+# GREG Benchmarks
+import sys
+import timeit
+import chess
+import chess.engine
+import GREGProtocol
+import GREGEvaluator
+import GREGWorker
+
+# Globals
+FENS = [
+    chess.STARTING_FEN,
+    "r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4",
+    "r2q1rk1/pp2bppp/2n1pn2/3p4/3P4/2NBPN2/PP3PPP/R2Q1RK1 w - - 0 10",
+    "8/5pk1/6p1/8/3R4/6P1/5PKP/r7 b - - 3 40",
+]
+REFERENCE_DEPTH = 14  # depth Stockfish judges the searches' moves at
+
+# Functions
+def usage(status):
+    '''
+    param:  status
+    return: None
+    Usage function that exits with STATUS
+    '''
+    print(f"Usage: ./GREGBenchmark.py [options] BENCHMARK")
+    print(f"    -n NUMBER  Iterations per measurement (default=20000)")
+    print(f"    -d DEPTH   Depth of the search benchmark (default=2)")
+    print(f"    -E EVAL    Leaf evaluator of the search benchmark (default={GREGEvaluator.DEFAULT})")
+    print(f"    -M WIDTH   MultiPV pre-screen width of the search benchmark, 0 to score every move (default=5)")
+    print(f"    -h         help")
+    print(f"Benchmarks:")
+    print(f"    protocol   JSON vs binary wire protocol, bytes/message and encode/decode time")
+    print(f"    evaluator  Leaves/sec of the Stockfish and static leaf evaluators")
+    print(f"    search     Nodes/sec and centipawns lost of the worker's searches")
+    exit(status)
+
+
+def measure(func, number):
+    '''
+    param:  func function:  function to time
+    param:  number int:     iterations
+    return: float microseconds per call
+    '''
+    return timeit.timeit(func, number=number) / number * 1e6
+
+
+def protocol_messages():
+    '''
+    param:  None
+    return: list of (name, message, messages per job in JSON, messages per job in binary)
+    Messages of one depth 1 job per benchmark position, one root move per task
+    like the server sends without batching
+    '''
+    messages = []
+    for fen in FENS:
+        board = chess.Board(fen)
+        moves = [move.uci() for move in board.legal_moves]
+        n     = len(moves)
+        messages.append(("task", {"listOfMoves":[moves[0]], "board":fen, "depth":1, "batch":1}, n, n))
+        messages.append(("position", {"type":"Position", "board":fen, "depth":1}, 0, 1))
+        messages.append(("result", {"type":"WorkerResult", "move":moves[0], "score":-25, "board":fen, "depth":1, "batch":1}, n, n))
+        messages.append(("request", {"board":fen, "depth":1}, 1, 1))
+        messages.append(("reply", {"move":moves[0], "score":-25}, 1, 1))
+    return messages
+
+
+def bench_protocol(number):
+    '''
+    param:  number int: iterations per measurement
+    return: None
+    Prints bytes/message and encode/decode time of both framings, and the
+    bytes a whole job puts on the wire
+    '''
+    totals = {GREGProtocol.JSON: 0, GREGProtocol.BINARY: 0}
+    stats  = dict()
+    for name, message, per_json, per_binary in protocol_messages():
+        for codec, per_job in ((GREGProtocol.JSON, per_json), (GREGProtocol.BINARY, per_binary)):
+            # the JSON path has no separate position message
+            if per_job == 0:
+                continue
+
+            # a binary task does not carry the board
+            if codec == GREGProtocol.BINARY and name == "task":
+                message = {"listOfMoves":message["listOfMoves"], "batch":message["batch"]}
+
+            data = GREGProtocol.encode(message, codec)
+            enc  = measure(lambda: GREGProtocol.encode(message, codec), number)
+            dec  = measure(lambda: GREGProtocol.decode(data), number)
+
+            entry = stats.setdefault((name, codec), [0, 0, 0, 0])
+            entry[0] += len(data)
+            entry[1] += enc
+            entry[2] += dec
+            entry[3] += 1
+            totals[codec] += len(data) * per_job
+
+    print(f"{'message':10} {'codec':7} {'bytes':>7} {'encode us':>10} {'decode us':>10}")
+    for (name, codec), (size, enc, dec, count) in stats.items():
+        print(f"{name:10} {codec:7} {size/count:7.1f} {enc/count:10.2f} {dec/count:10.2f}")
+
+    print(f"bytes per job over {len(FENS)} positions:")
+    for codec, total in totals.items():
+        print(f"    {codec:7} {total/len(FENS):9.1f}")
+
+    # binary workers keep the job's board instead of parsing the FEN per task
+    fen = FENS[1]
+    print(f"FEN parse per JSON task: {measure(lambda: chess.Board(fen), number // 10):.2f} us")
+
+
+def leaf_positions():
+    '''
+    param:  None
+    return: list of boards, every position two plies after a benchmark position
+    '''
+    leaves = []
+    for fen in FENS:
+        board = chess.Board(fen)
+        for move in board.legal_moves:
+            board.push(move)
+            for reply in board.legal_moves:
+                board.push(reply)
+                leaves.append(board.copy(stack=False))
+                board.pop()
+            board.pop()
+    return leaves
+
+
+def bench_evaluator(number):
+    '''
+    param:  number int: iterations per measurement, divided by the leaves per batch
+    return: None
+    Prints leaves/sec of each evaluator, scoring the leaves one at a time like
+    score_move and in batches of sibling leaves like the pre-screen of solve
+    '''
+    leaves  = leaf_positions()
+    batches = [leaves[i:i + 30] for i in range(0, len(leaves), 30)]
+    repeat  = max(1, number // len(leaves))
+    print(f"{len(leaves)} leaves, numpy {'on' if GREGEvaluator.numpy is not None else 'off'}")
+    print(f"{'evaluator':10} {'mode':7} {'leaves/sec':>12}")
+
+    engine = chess.engine.SimpleEngine.popen_uci("./bin/stockfish")
+    try:
+        for name in GREGEvaluator.EVALUATORS:
+            evaluator = GREGEvaluator.create(name, engine)
+            # the engine is slow, one pass is plenty
+            n = 1 if name == "stockfish" else repeat
+            single  = measure(lambda: [evaluator.evaluate([leaf]) for leaf in leaves], n)
+            batched = measure(lambda: [evaluator.evaluate(batch) for batch in batches], n)
+            print(f"{name:10} {'single':7} {len(leaves) / single * 1e6:12.0f}")
+            print(f"{name:10} {'batch':7} {len(leaves) / batched * 1e6:12.0f}")
+    finally:
+        engine.quit()
+
+
+def bench_search(depth, evaluator, multipv):
+    '''
+    param:  depth int:          depth of the searches
+    param:  evaluator string:   leaf evaluator
+    param:  multipv int:        MultiPV pre-screen width of solve
+    return: None
+    Searches every root move of each benchmark position like the workers of
+    a job would, and prints nodes/sec and how many centipawns the chosen move
+    loses to Stockfish's best move at REFERENCE_DEPTH
+    '''
+    engine    = chess.engine.SimpleEngine.popen_uci("./bin/stockfish")
+    reference = chess.engine.SimpleEngine.popen_uci("./bin/stockfish")
+    worker    = GREGWorker.ChessWorker([engine], discovery=None, evaluator=evaluator, multipv=multipv)
+    worker.bind_engine()
+
+    limit = chess.engine.Limit(depth=REFERENCE_DEPTH)
+    print(f"{'search':7} {'position':>8} {'move':6} {'cp lost':>8} {'nodes':>8} {'secs':>7} {'nodes/sec':>10}")
+    try:
+        for search in worker.SEARCHES:
+            worker.search = search
+            for n, fen in enumerate(FENS):
+                board = chess.Board(fen)
+                worker.table = GREGWorker.GREGTransposition.TranspositionTable(16 * 1024 * 1024)
+                worker.local.nodes = 0
+
+                start = timeit.default_timer()
+                best  = (None, float("-inf"))
+                for move in board.legal_moves:
+                    worker.table.new_search()
+                    if search == "pvs":
+                        result = worker.search_root(move.uci(), board, depth)
+                    else:
+                        result = worker.solve([move.uci()], board, depth)
+                    if result[1] > best[1]:
+                        best = result
+                elapsed = timeit.default_timer() - start
+
+                top  = reference.analyse(board, limit, game=object())["score"].relative.score(mate_score=GREGEvaluator.MATE_SCORE)
+                move = chess.Move.from_uci(best[0])
+                got  = reference.analyse(board, limit, root_moves=[move], game=object())["score"].relative.score(mate_score=GREGEvaluator.MATE_SCORE)
+                print(f"{search:7} {n:8} {best[0]:6} {max(0, top - got):8} {worker.local.nodes:8} {elapsed:7.2f} {worker.local.nodes / elapsed:10.0f}", flush=True)
+    finally:
+        engine.quit()
+        reference.quit()
+
+
+# Main Execution
+def main():
+    number = 20000
+    depth  = 2
+    evaluator = GREGEvaluator.DEFAULT
+    multipv = 5
+    bench  = None
+    argind = 1
+
+    # parse args
+    while argind < len(sys.argv):
+        arg = sys.argv[argind]
+
+        if arg == "-n":
+            argind += 1
+            number = int(sys.argv[argind])
+        elif arg == "-d":
+            argind += 1
+            depth = int(sys.argv[argind])
+        elif arg == "-E":
+            argind += 1
+            evaluator = sys.argv[argind]
+        elif arg == "-M":
+            argind += 1
+            multipv = int(sys.argv[argind])
+        elif arg == "-h":
+            usage(0)
+        elif bench is None and not arg.startswith("-"):
+            bench = arg
+        else:
+            usage(1)
+        argind += 1
+
+    if bench == "protocol":
+        bench_protocol(number)
+    elif bench == "evaluator":
+        bench_evaluator(number)
+    elif bench == "search":
+        bench_search(depth, evaluator, multipv)
+    else:
+        usage(1)
+
+if __name__ == "__main__":
+    main()
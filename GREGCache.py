@@ -0,0 +1,299 @@
+# GREG Cache
+import sys
+import time
+import struct
+import collections
+import zmq
+import GREGProtocol
+import GREGDiscovery
+import GREGTransposition
+
+# Globals
+SERVICE  = "chessCache"
+TIMEOUT  = 200   # msecs a lookup waits for the cache before searching without it
+BACKOFF  = 5     # secs a cache that did not answer is skipped
+PUT_BATCH = 256  # stores buffered before they are sent
+AGE_INTERVAL = 60       # secs between generations of the table, older entries are replaced first
+REGISTER_INTERVAL = 60  # secs between registrations with the discovery backend
+STATS_INTERVAL = 10     # secs between hit rates printed with -d
+
+# message types, every message starts with the type and a request number
+GET  = 1
+PUT  = 2
+HITS = 3
+
+HEADER = struct.Struct("!BI")
+KEY    = struct.Struct("!QB")       # key, least depth wanted
+ENTRY  = struct.Struct("!QBBiH")    # key, depth, bound, score, best move
+
+# Functions
+def usage(status):
+    '''
+    param:  status
+    return: None
+    Usage function that exits with STATUS
+    '''
+    print(f"Usage: ./GREGCache.py [options]")
+    print(f"    -n NAME    Add unique name")
+    print(f"    -d         Print every worker's hit rate every {STATS_INTERVAL} secs")
+    print(f"    -t MB      Table size in MB (default=64)")
+    print(f"    -p PORT    Port to bind (default=random, registered with the discovery backend)")
+    print(f"    -D SPEC    Discovery backend (default={GREGDiscovery.DEFAULT})")
+    print(f"    -h         help")
+    exit(status)
+
+
+def pack_entries(entries):
+    '''
+    param:  entries list:   (key, depth, score, move, bound) tuples
+    return: bytes of the entries
+    '''
+    return b"".join(ENTRY.pack(key, depth, bound, score, GREGProtocol.pack_move(move)) for key, depth, score, move, bound in entries)
+
+
+def unpack_entries(data):
+    '''
+    param:  data bytes: entries from pack_entries
+    return: list of (key, depth, score, move, bound) tuples
+    '''
+    return [(key, depth, score, GREGProtocol.unpack_move(move), bound) for key, depth, bound, score, move in ENTRY.iter_unpack(data)]
+
+
+def find(discovery, name=""):
+    '''
+    param:  discovery Discovery:    backend the cache registered with
+    param:  name string:            unique name of the deployment
+    return: HOST:PORT of a cache service, None if none is registered
+    '''
+    for item in discovery.lookup(f"{name}{SERVICE}"):
+        return f"{item['name']}:{item['port']}"
+    return None
+
+
+# Classes
+class CacheClient:
+    '''
+    Connection of one search thread to a cache service. The positions a node
+    is about to search are looked up in one request, and stores are buffered
+    and sent PUT_BATCH at a time without waiting for an answer. A cache that
+    does not answer within TIMEOUT is skipped for BACKOFF secs, so searches
+    never wait on it for long. Keys are xored with SALT on the wire, so
+    searches that score positions differently do not share entries
+    '''
+    def __init__(self, context, address, identity, salt=0, timeout=TIMEOUT):
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.IDENTITY, identity.encode())
+        self.socket.connect(f"tcp://{address}")
+        self.salt    = salt
+        self.timeout = timeout
+        self.puts    = []
+        self.request = 0
+        self.skip_until = 0
+        self.probes  = 0
+        self.hits    = 0
+
+
+    def get(self, keys, depth):
+        '''
+        param:  keys list:  Zobrist keys of the positions
+        param:  depth int:  least depth of the entries wanted
+        return: list of (key, depth, score, move, bound) the cache has
+        '''
+        if not keys or self.skip_until > time.time():
+            return []
+
+        self.request += 1
+        self.probes  += len(keys)
+        self.socket.send(HEADER.pack(GET, self.request) + b"".join(KEY.pack(key ^ self.salt, depth) for key in keys))
+
+        # drop answers to lookups that timed out before
+        while self.socket.poll(self.timeout):
+            data = self.socket.recv()
+            if HEADER.unpack_from(data)[1] != self.request:
+                continue
+            entries = unpack_entries(data[HEADER.size:])
+            self.hits += len(entries)
+            return [(key ^ self.salt, depth, score, move, bound) for key, depth, score, move, bound in entries]
+
+        self.skip_until = time.time() + BACKOFF
+        return []
+
+
+    def put(self, key, depth, score, move=None, bound=GREGTransposition.EXACT):
+        '''
+        param:  key int:      Zobrist key of the position
+        param:  depth int:    depth the position was searched to
+        param:  score int:    score from the side to move
+        param:  move string:  best move of the side to move, None if unknown
+        param:  bound int:    EXACT, or LOWER/UPPER if the search failed high/low
+        return: None
+        '''
+        self.puts.append((key ^ self.salt, depth, score, move, bound))
+        if len(self.puts) >= PUT_BATCH:
+            self.flush()
+
+
+    def flush(self):
+        '''
+        param:  None
+        return: None
+        Sends the buffered stores
+        '''
+        if self.puts:
+            self.socket.send(HEADER.pack(PUT, 0) + pack_entries(self.puts))
+            self.puts = []
+
+
+    def close(self):
+        '''
+        param:  None
+        return: None
+        '''
+        self.flush()
+        self.socket.close()
+
+
+class CacheServer:
+    '''
+    Transposition table shared by the search threads of every worker. It is
+    a GREGTransposition table, so its memory is fixed and a deeper entry is
+    only replaced by a shallower one once it is from an older generation
+    '''
+    def __init__(self, table_mb=64, name="", port=0, discovery=GREGDiscovery.DEFAULT, debug=False):
+        self.table = GREGTransposition.TranspositionTable(table_mb * 1024 * 1024)
+        self.name  = name
+        self.debug = debug
+        self.discovery = GREGDiscovery.create(discovery)
+        self.context = zmq.Context()
+        self.socket  = self.context.socket(zmq.ROUTER)
+        if port:
+            self.socket.bind(f"tcp://*:{port}")
+            self.port = port
+        else:
+            self.port = self.socket.bind_to_random_port("tcp://*")
+
+        # probes and hits per worker, a worker's threads share its name
+        self.workers = collections.defaultdict(lambda: [0, 0])
+        self.aged_at = time.time()
+        self.registered_at = 0
+        self.stats_at = time.time() + STATS_INTERVAL
+
+
+    def printg(self, msg, alwaysPrint=False):
+        '''
+        param:  msg string:         message to print
+        param:  alwaysPrint bool:   if message should always print
+        return: None
+        Wrapper for print statements for debugging
+        '''
+        if alwaysPrint or self.debug:
+            print(msg, flush=True)
+
+
+    def lookup(self, worker, data):
+        '''
+        param:  worker string:  worker that asked
+        param:  data bytes:     keys and least depths wanted
+        return: bytes of the entries found at least that deep
+        '''
+        found = []
+        for key, depth in KEY.iter_unpack(data):
+            entry = self.table.probe(key)
+            if entry is not None and entry[0] >= depth:
+                found.append((key,) + entry)
+
+        stats = self.workers[worker]
+        stats[0] += len(data) // KEY.size
+        stats[1] += len(found)
+        return pack_entries(found)
+
+
+    def store(self, data):
+        '''
+        param:  data bytes: entries to store
+        return: None
+        '''
+        for key, depth, score, move, bound in unpack_entries(data):
+            self.table.store(key, depth, score, move, bound)
+
+
+    def housekeeping(self):
+        '''
+        param:  None
+        return: None
+        Registers with the discovery backend, ages the table and prints the
+        hit rates when they are due
+        '''
+        now = time.time()
+        if self.registered_at <= now:
+            self.discovery.register(f"{self.name}{SERVICE}", self.port)
+            self.registered_at = now + REGISTER_INTERVAL
+        if self.aged_at + AGE_INTERVAL <= now:
+            self.table.new_search()
+            self.aged_at = now
+        if self.stats_at <= now:
+            for worker, (probes, hits) in sorted(self.workers.items()):
+                self.printg(f"{worker}: {hits}/{probes} hits ({hits / probes if probes else 0:.1%})")
+            self.printg(self.table.stats())
+            self.stats_at = now + STATS_INTERVAL
+
+
+    def run(self):
+        '''
+        param:  None
+        return: None
+        Answers lookups and takes stores until killed
+        '''
+        self.printg(f"listening on port {self.port}", True)
+        while True:
+            self.housekeeping()
+            if not self.socket.poll(1000):
+                continue
+
+            identity, data = self.socket.recv_multipart()
+            msg_type, request = HEADER.unpack_from(data)
+            if msg_type == GET:
+                worker = identity.decode(errors="replace").rsplit(":", 1)[0]
+                self.socket.send_multipart([identity, HEADER.pack(HITS, request) + self.lookup(worker, data[HEADER.size:])])
+            elif msg_type == PUT:
+                self.store(data[HEADER.size:])
+
+
+# Main Execution
+def main():
+    name   = ""
+    debug  = False
+    table  = 64
+    port   = 0
+    discovery = GREGDiscovery.DEFAULT
+    argind = 1
+
+    # parse args
+    while argind < len(sys.argv):
+        arg = sys.argv[argind]
+
+        if arg == "-n":
+            argind += 1
+            name = sys.argv[argind]
+        elif arg == "-d":
+            debug = True
+        elif arg == "-t":
+            argind += 1
+            table = int(sys.argv[argind])
+        elif arg == "-p":
+            argind += 1
+            port = int(sys.argv[argind])
+        elif arg == "-D":
+            argind += 1
+            discovery = sys.argv[argind]
+        elif arg == "-h":
+            usage(0)
+        else:
+            usage(1)
+        argind += 1
+
+    CacheServer(table, name, port, discovery, debug).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# GREG Catalog
+import sys
+import time
+import json
+import socket
+import threading
+import http.server
+
+# Globals
+Entries = dict()
+Lock    = threading.Lock()
+
+# Functions
+def usage(status):
+    '''
+    param:  status
+    return: None
+    Usage function that exits with STATUS
+    '''
+    print(f"Usage: ./GREGCatalog.py [options]")
+    print(f"    -p PORT    Port for UDP registration and HTTP queries (default=9097)")
+    print(f"    -t SECS    Forget servers not heard from in SECS (default=300)")
+    print(f"    -h         help")
+    exit(status)
+
+
+def expire(timeout):
+    '''
+    param:  timeout int: secs after which an entry is forgotten
+    return: None
+    Drops entries that stopped registering
+    '''
+    now = time.time()
+    with Lock:
+        for key in [key for key, item in Entries.items() if item["lastheardfrom"] + timeout < now]:
+            del Entries[key]
+
+
+# Classes
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serves /query.json like catalog.cse.nd.edu
+    '''
+    def do_GET(self):
+        if self.path != "/query.json":
+            self.send_error(404)
+            return
+
+        with Lock:
+            body = json.dumps(list(Entries.values())).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Main Execution
+def main():
+    port    = 9097
+    timeout = 300
+    argind  = 1
+
+    # parse args
+    while argind < len(sys.argv):
+        arg = sys.argv[argind]
+
+        if arg == "-p":
+            argind += 1
+            port = int(sys.argv[argind])
+        elif arg == "-t":
+            argind += 1
+            timeout = int(sys.argv[argind])
+        elif arg == "-h":
+            usage(0)
+        else:
+            usage(1)
+        argind += 1
+
+    # queries are answered from a thread
+    httpd = http.server.ThreadingHTTPServer(("", port), QueryHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    # registrations come in by UDP
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("", port))
+    print("listening on port", port)
+
+    while True:
+        msg, addr = s.recvfrom(65536)
+        try:
+            item = json.loads(msg)
+        except ValueError:
+            continue
+
+        # the catalog names servers by the address they registered from
+        item["name"] = addr[0]
+        item["lastheardfrom"] = int(time.time())
+        with Lock:
+            Entries[(item.get("type"), addr[0], item.get("port"))] = item
+        expire(timeout)
+
+if __name__ == "__main__":
+    main()
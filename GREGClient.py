@@ -2,26 +2,28 @@
 import zmq
 import zmq.utils.monitor
 import chess
+import chess.pgn
 import sys
-import http.client
-import json
 import time
 import signal
 import os
-
-# Globals
-NSERVER      = "catalog.cse.nd.edu:9097"
-UPDATE_DELAY = 60
+import socket
+import GREGProtocol
+import GREGDiscovery
 
 # Functions
 def usage(status):
 
     print(f"Usage: ./GREGClient.py [options]")
-    print(f"    -d DEPTH    Depth of searches (depth = 1)")
+    print(f"    -d DEPTH    Depth of searches (depth = 1, {ChessClient.MAX_DEPTH} with -t)")
+    print(f"    -t MSECS    Time each search gets, the best move found by then is played")
     print(f"    -n NAME     Add unique name")
     print(f"    -b          Play as black instead of white")
+    print(f"    -a PGN      Analyse every position of a game instead of playing")
     print(f"    -h          help")
     print(f"    -s          silent mode")
+    print(f"    -j          JSON only wire protocol")
+    print(f"    -D SPEC     Discovery backend (default={GREGDiscovery.DEFAULT})")
 
     exit(status)
 
@@ -29,19 +31,28 @@ def usage(status):
 class ChessClient:
     HEARTBEAT_INTERVAL = 5000
     HEARTBEAT_INTERVAL_S = 5
+    CONNECT_TIMEOUT = 2000  # msecs to wait for a handshake
+    RETRY_DELAY = 1         # secs between discovery attempts
+    MAX_DEPTH = 16          # depth of timed searches when none is given
 
     #########################
     #    Class Functions    #
     #########################
-    def __init__(self, depth=1, isBlack=True, name="", silent=False):
+    def __init__(self, depth=1, isBlack=True, name="", silent=False, codec=GREGProtocol.BINARY, discovery=GREGDiscovery.DEFAULT, movetime=None):
         self.board   = chess.Board()
+        self.offer   = codec
+        self.codec   = GREGProtocol.JSON
         self.context = zmq.Context()
         self.isBlack = isBlack
         self.depth   = depth
+        self.movetime = movetime
         self.name    = name
         self.silent  = silent
         self.connected = False
         self.heartbeat_at = 0
+        self.next_id = 0
+        self.request_id = None
+        self.discovery = GREGDiscovery.create(discovery)
         self.find_server()
 
         signal.setitimer(signal.ITIMER_REAL, self.HEARTBEAT_INTERVAL_S, self.HEARTBEAT_INTERVAL_S)
@@ -68,36 +79,35 @@ class ChessClient:
         '''
         param:  None
         return: None
-        Locate chess service and connect to it
+        Locate chess service and connect to it. With several servers every
+        client has its own one on the hash ring, the others are fallbacks
         '''
+        service = f"{self.name}chessClient"
         while True:
-            conn = http.client.HTTPConnection(NSERVER)
-            conn.request("GET", "/query.json")
-            js   = json.loads(conn.getresponse().read())
-            
-            self.context = zmq.Context()
-           
-
-            # look for available server
-            for item in js:
-                if "type" in item and item["type"] == f"{self.name}chessClient" and int(item["lastheardfrom"]) + UPDATE_DELAY > time.time():
-                    self.printg(item)
-                    self.port = item["port"]
-                    self.host = item["name"]
-
-                    try:
-                        self.socket = self.context.socket(zmq.DEALER)
-                        self.monitor = self.socket.get_monitor_socket(zmq.EVENT_CLOSED|zmq.EVENT_HANDSHAKE_SUCCEEDED|zmq.EVENT_DISCONNECTED)
-                        if self.connect():
-                            self.connected = True
-                            return
-                        else:
-                            self.monitor.close()
-                            self.socket.close()
-
-                    except zmq.ZMQError as exc:
-                        self.printg(exc)
-                    
+            # look for available server, lookups are cached by the discovery
+            for item in GREGDiscovery.by_ring(self.discovery.lookup(service), f"{socket.gethostname()}:{os.getpid()}"):
+                self.printg(item)
+                self.port = item["port"]
+                self.host = item["name"]
+
+                try:
+                    self.socket = self.context.socket(zmq.DEALER)
+                    self.socket.setsockopt(zmq.LINGER, 0)
+                    self.monitor = self.socket.get_monitor_socket(zmq.EVENT_CLOSED|zmq.EVENT_HANDSHAKE_SUCCEEDED|zmq.EVENT_DISCONNECTED)
+                    if self.connect():
+                        self.connected = True
+                        return
+                    else:
+                        self.monitor.close()
+                        self.socket.close()
+
+                except zmq.ZMQError as exc:
+                    self.printg(exc)
+
+            # nothing reachable, ask the backend again after a pause
+            self.discovery.invalidate(service)
+            time.sleep(self.RETRY_DELAY)
+
     def connect(self):
         '''
         param:  None
@@ -106,11 +116,14 @@ class ChessClient:
         '''
         self.socket.connect(f"tcp://{self.host}:{self.port}")
         
+        # give up if the server never answers
+        self.monitor.setsockopt(zmq.RCVTIMEO, self.CONNECT_TIMEOUT)
         try:
             event = zmq.utils.monitor.recv_monitor_message(self.monitor)
         except zmq.ZMQError as e:
             self.printg(e)
             return False
+        self.monitor.setsockopt(zmq.RCVTIMEO, -1)
         if event['event'] == zmq.EVENT_HANDSHAKE_SUCCEEDED:
             return True
         elif event['event'] == zmq.EVENT_CLOSED:
@@ -126,10 +139,54 @@ class ChessClient:
         Sends heartbeat to server
         '''
         if self.connected and self.heartbeat_at < time.time():
-            msg = json.dumps({"type": "<3"}).encode()
+            msg = GREGProtocol.encode({"type": "<3"}, self.codec)
             self.socket.send(msg)
             self.update_expiry()
 
+    def request_move(self, board=None):
+        '''
+        param:  board Board: board to search, the game board by default
+        return: id of the request
+        Asks the server for the best move of a board. Every request gets its
+        own id so several can be in flight on one connection. Timed requests
+        are answered with the best move found within the movetime
+        '''
+        if board is None:
+            board = self.board
+
+        self.next_id += 1
+        request = {"board":board.fen(), "depth":self.depth, "id":self.next_id, "codec":self.offer}
+        if self.movetime:
+            request["movetime"] = self.movetime
+        msg = GREGProtocol.encode(request, self.codec)
+        self.socket.send(msg)
+        self.update_expiry()
+        return self.next_id
+
+
+    def recv_reply(self):
+        '''
+        param:  None
+        return: reply dict sent by the server
+        Receives a reply, switching to the binary framing once the server uses it
+        '''
+        id_, data = self.socket.recv_multipart()
+        if GREGProtocol.is_binary(data):
+            self.codec = GREGProtocol.BINARY
+        return GREGProtocol.decode(data)
+
+
+    def recv_move(self):
+        '''
+        param:  None
+        return: move string for the game's pending request, None for a stale reply
+        '''
+        reply = self.recv_reply()
+        if reply.get("id") != self.request_id:
+            return None
+        return reply["move"]
+
+
     def update_expiry(self):
         '''
         param:  None
@@ -159,16 +216,14 @@ class ChessClient:
             self.printg(self.board.unicode(borders=True,invert_color=True,empty_square=" ", orientation=not self.isBlack))
             
             # ask for move
-            b = self.board.fen()
-            self.socket.send(bytes(json.dumps({"board":b, "depth":self.depth}), "utf-8"))
-            self.update_expiry()
+            self.request_id = self.request_move()
             
             # recv move
-            id_, msg = self.socket.recv_multipart()
-            msg      = json.loads(msg)
+            move = None
+            while move is None:
+                move = self.recv_move()
             
             # convert move and push to board
-            move = msg["move"]
             move = chess.Move.from_uci(move)
             self.board.push(move)
             
@@ -219,9 +274,7 @@ class ChessClient:
             if try_send:
 
                 # send the message
-                b = self.board.fen()
-                self.socket.send(bytes(json.dumps({"board":b, "depth":self.depth}), "utf-8"))
-                self.update_expiry()
+                self.request_id = self.request_move()
 
             socks = dict(poller.poll())
 
@@ -232,6 +285,7 @@ class ChessClient:
                 if event['event'] == zmq.EVENT_CLOSED or event['event'] == zmq.EVENT_DISCONNECTED:
                     try_send = True
                     self.connected = False
+                    self.codec = GREGProtocol.JSON
                     self.monitor.close()
                     self.socket.close()
                     self.find_server()
@@ -245,26 +299,62 @@ class ChessClient:
             # recv move
             if self.socket in socks and socks[self.socket] == zmq.POLLIN:
 
-                id_, msg = self.socket.recv_multipart()
-                msg      = json.loads(msg)
-                
+                move = self.recv_move()
+
+                # reply to a request abandoned on reconnect
+                if move is None:
+                    new_move = False
+                    try_send = False
+                    continue
                 
                 # convert move and push to board
-                move = msg["move"]
                 move = chess.Move.from_uci(move)
                 self.board.push(move)
                 if not self.silent:
                     os.system('clear')
                 new_move = True
+
+
+    def analyse_game(self, path):
+        '''
+        param:  path string: PGN file of the game
+        return: None
+        Pipelines a request for every position of a game and prints the
+        server's best move next to the move that was played
+        '''
+        with open(path) as f:
+            game = chess.pgn.read_game(f)
+
+        # send everything before waiting on anything
+        board   = game.board()
+        pending = dict()
+        for ply, move in enumerate(game.mainline_moves()):
+            pending[self.request_move(board)] = (ply, board.copy(stack=False), move)
+            board.push(move)
+
+        replies = dict()
+        while len(replies) < len(pending):
+            reply = self.recv_reply()
+            if reply.get("id") in pending:
+                replies[reply["id"]] = reply
+
+        for request_id, (ply, board, move) in sorted(pending.items()):
+            reply = replies[request_id]
+            best  = board.san(chess.Move.from_uci(reply["move"]))
+            print(f"{ply // 2 + 1}{'.' if ply % 2 == 0 else '...'} {board.san(move):8} best {best:8} score {reply['score']}", flush=True)
                  
 
 # Main Execution
 def main():
     # options
-    depth   = 1
+    depth   = None
+    movetime = None
     isBlack = False
     silent  = False
     name    = ""
+    codec   = GREGProtocol.BINARY
+    pgn     = None
+    discovery = GREGDiscovery.DEFAULT
     argind  = 1
     
     # parse command args
@@ -273,6 +363,9 @@ def main():
         if arg == "-d":
             argind += 1
             depth = int(sys.argv[argind])
+        elif arg == "-t":
+            argind += 1
+            movetime = int(sys.argv[argind])
         elif arg == "-b":
             isBlack = True
         elif arg == "-n":
@@ -280,16 +373,34 @@ def main():
             name = sys.argv[argind]
         elif arg == "-s":
             silent = True
+        elif arg == "-j":
+            codec = GREGProtocol.JSON
+        elif arg == "-a":
+            argind += 1
+            pgn = sys.argv[argind]
+        elif arg == "-D":
+            argind += 1
+            discovery = sys.argv[argind]
         elif arg == "-h":
             usage(0)
         else:
             usage(1)
         argind += 1
+
+    # timed searches go as deep as time allows unless told otherwise
+    if depth is None:
+        depth = ChessClient.MAX_DEPTH if movetime else 1
     
+    # analyse a whole game
+    if pgn is not None:
+        client = ChessClient(depth, isBlack, name, True, codec, discovery, movetime)
+        client.analyse_game(pgn)
+        exit(0)
+
     # play game
     if not silent:
         print("Welcome to the GREG chess application! (q to quit)")      
-    client = ChessClient(depth, isBlack, name, silent)
+    client = ChessClient(depth, isBlack, name, silent, codec, discovery, movetime)
     client.play_game()
 
 
@@ -0,0 +1,226 @@
+# GREG Discovery
+import os
+import time
+import fcntl
+import json
+import socket
+import bisect
+import hashlib
+import http.client
+
+# Globals
+DEFAULT   = "catalog:catalog.cse.nd.edu:9097"
+TTL       = 5    # secs a lookup is cached
+FRESHNESS = 60   # secs since a catalog last heard from a server for it to count
+REPLICAS  = 64   # points of every server on the hash ring
+
+# Functions
+def create(spec=DEFAULT, ttl=TTL):
+    '''
+    param:  spec string:  discovery backend, one of
+                catalog:HOST:PORT           catalog server (HTTP query, UDP registration)
+                static:HOST:CPORT:WPORT     fixed server address and client/worker ports
+                file:PATH                   JSON file shared by server, workers and clients
+    param:  ttl float:    secs lookups are cached
+    return: Discovery backend
+    '''
+    kind, _, rest = spec.partition(":")
+    if kind == "catalog":
+        host, port = rest.rsplit(":", 1)
+        return CatalogDiscovery(host, int(port), ttl)
+    if kind == "static":
+        host, c_port, w_port = rest.rsplit(":", 2)
+        return StaticDiscovery(host, int(c_port), int(w_port))
+    if kind == "file":
+        return FileDiscovery(rest, ttl)
+    raise ValueError(f"unknown discovery spec {spec}")
+
+
+def is_fresh(item):
+    '''
+    param:  item dict: catalog entry
+    return: True if the server registered recently
+    '''
+    return "lastheardfrom" not in item or int(item["lastheardfrom"]) + FRESHNESS > time.time()
+
+
+def ring_hash(text):
+    '''
+    param:  text string:  server address or key
+    return: int 64 bit position on the hash ring, the same in every process
+    '''
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+
+def by_ring(entries, key, replicas=REPLICAS):
+    '''
+    param:  entries list:   entries of the servers of one service
+    param:  key string:     what is placed on the ring, e.g. a client's address
+    param:  replicas int:   points of every server on the ring
+    return: entries in the order KEY tries them, the server owning KEY first
+            and the ones to fail over to after it
+    Consistent hashing: a server joining or leaving only moves the keys it owns
+    '''
+    ring = sorted((ring_hash(f"{item['name']}:{item['port']}#{i}"), n) for n, item in enumerate(entries) for i in range(replicas))
+    start = bisect.bisect(ring, (ring_hash(key), len(entries)))
+
+    order = []
+    for i in range(len(ring)):
+        n = ring[(start + i) % len(ring)][1]
+        if n not in order:
+            order.append(n)
+            if len(order) == len(entries):
+                break
+    return [entries[n] for n in order]
+
+
+# Classes
+class Discovery:
+    '''
+    Finds servers by service type (e.g. "demochessWorker") and lets a server
+    register its ports. Lookups are cached for TTL seconds so reconnect loops
+    do not hammer the backend. Several servers may register one service type,
+    by_ring spreads clients and workers over them
+    '''
+    def __init__(self, ttl=TTL):
+        self.ttl   = ttl
+        self.cache = dict()
+
+
+    def lookup(self, service):
+        '''
+        param:  service string: service type to find
+        return: list of entries, each a dict with at least "name" (host) and "port"
+        '''
+        cached = self.cache.get(service)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        entries = [item for item in self.query() if item.get("type") == service and is_fresh(item)]
+        self.cache[service] = (time.time() + self.ttl, entries)
+        return entries
+
+
+    def invalidate(self, service):
+        '''
+        param:  service string: service whose cached entries failed
+        return: None
+        '''
+        self.cache.pop(service, None)
+
+
+    def query(self):
+        '''
+        param:  None
+        return: list of every entry the backend knows, none by default
+        '''
+        return []
+
+
+    def bind_port(self, service):
+        '''
+        param:  service string: service a server is about to bind
+        return: port to bind, 0 for a random one
+        '''
+        return 0
+
+
+    def register(self, service, port):
+        '''
+        param:  service string: service type served
+        param:  port int:       port it is served on
+        return: None
+        '''
+        pass
+
+
+class CatalogDiscovery(Discovery):
+    '''
+    Catalog server: entries are read from HTTP /query.json and servers
+    register by UDP, like catalog.cse.nd.edu or a local GREGCatalog.py
+    '''
+    def __init__(self, host, port, ttl=TTL):
+        super().__init__(ttl)
+        self.host = host
+        self.port = port
+
+
+    def query(self):
+        try:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=5)
+            conn.request("GET", "/query.json")
+            return json.loads(conn.getresponse().read())
+        except (OSError, ValueError):
+            return []
+
+
+    def register(self, service, port):
+        addrs = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC, socket.SOCK_DGRAM)
+        for addr in addrs:
+            ai_fam, stype, proto, name, sa = addr
+            try:
+                s = socket.socket(ai_fam, stype, proto)
+            except:
+                continue
+
+            s.sendto(json.dumps({"type":service,"owner":"MMBW","port":port,"project":"GREGChessApp"}).encode(), sa)
+            s.close()
+            break
+
+
+class StaticDiscovery(Discovery):
+    '''
+    Fixed server address, works offline. The server binds the given ports
+    '''
+    def __init__(self, host, c_port, w_port):
+        super().__init__(0)
+        self.host  = host
+        self.ports = {"chessClient": c_port, "chessWorker": w_port}
+
+
+    def port(self, service):
+        for suffix, port in self.ports.items():
+            if service.endswith(suffix):
+                return port
+        return 0
+
+
+    def lookup(self, service):
+        port = self.port(service)
+        return [{"type":service, "name":self.host, "port":port}] if port else []
+
+
+    def bind_port(self, service):
+        return self.port(service)
+
+
+class FileDiscovery(Discovery):
+    '''
+    JSON file in the catalog's format, for machines sharing a filesystem
+    '''
+    def __init__(self, path, ttl=TTL):
+        super().__init__(ttl)
+        self.path = path
+
+
+    def query(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+
+    def register(self, service, port):
+        # servers sharing the file register one at a time, or one could
+        # overwrite the entry another just added
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = [item for item in self.query() if is_fresh(item) and not (item.get("type") == service and item.get("name") == socket.getfqdn() and item.get("port") == port)]
+            entries.append({"type":service, "name":socket.getfqdn(), "port":port, "lastheardfrom":int(time.time())})
+
+            # replace atomically so readers never see a partial file
+            tmp = f"{self.path}.{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
@@ -0,0 +1,205 @@
+# GREG Evaluator
+import abc
+import chess
+import chess.engine
+
+# numpy is optional, the static evaluator scores leaves one by one without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Globals
+DEFAULT    = "stockfish"
+EVALUATORS = ["stockfish", "static"]
+MATE_SCORE = 100000
+BATCH_MIN  = 8   # leaves below which the static evaluator skips numpy
+
+PIECES = [(color, piece_type) for color in chess.COLORS for piece_type in chess.PIECE_TYPES]
+VALUES = {chess.PAWN: 100, chess.KNIGHT: 320, chess.BISHOP: 330, chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+
+# piece-square tables from white's side, rank 8 first like a printed board
+TABLES = {
+    chess.PAWN: [
+          0,   0,   0,   0,   0,   0,   0,   0,
+         50,  50,  50,  50,  50,  50,  50,  50,
+         10,  10,  20,  30,  30,  20,  10,  10,
+          5,   5,  10,  25,  25,  10,   5,   5,
+          0,   0,   0,  20,  20,   0,   0,   0,
+          5,  -5, -10,   0,   0, -10,  -5,   5,
+          5,  10,  10, -20, -20,  10,  10,   5,
+          0,   0,   0,   0,   0,   0,   0,   0],
+    chess.KNIGHT: [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20,   0,   0,   0,   0, -20, -40,
+        -30,   0,  10,  15,  15,  10,   0, -30,
+        -30,   5,  15,  20,  20,  15,   5, -30,
+        -30,   0,  15,  20,  20,  15,   0, -30,
+        -30,   5,  10,  15,  15,  10,   5, -30,
+        -40, -20,   0,   5,   5,   0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50],
+    chess.BISHOP: [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,  10,  10,   5,   0, -10,
+        -10,   5,   5,  10,  10,   5,   5, -10,
+        -10,   0,  10,  10,  10,  10,   0, -10,
+        -10,  10,  10,  10,  10,  10,  10, -10,
+        -10,   5,   0,   0,   0,   0,   5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20],
+    chess.ROOK: [
+          0,   0,   0,   0,   0,   0,   0,   0,
+          5,  10,  10,  10,  10,  10,  10,   5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+          0,   0,   0,   5,   5,   0,   0,   0],
+    chess.QUEEN: [
+        -20, -10, -10,  -5,  -5, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,   5,   5,   5,   0, -10,
+         -5,   0,   5,   5,   5,   5,   0,  -5,
+          0,   0,   5,   5,   5,   5,   0,  -5,
+        -10,   5,   5,   5,   5,   5,   0, -10,
+        -10,   0,   5,   0,   0,   0,   0, -10,
+        -20, -10, -10,  -5,  -5, -10, -10, -20],
+    chess.KING: [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+         20,  20,   0,   0,   0,   0,  20,  20,
+         20,  30,  10,   0,   0,  10,  30,  20],
+}
+
+# Functions
+def create(name=DEFAULT, engine=None):
+    '''
+    param:  name string:        evaluator, one of
+                stockfish   depth 0 analysis of every leaf by the engine
+                static      material and piece-square tables, in process
+    param:  engine SimpleEngine: engine of the search thread
+    return: Evaluator
+    '''
+    if name == "stockfish":
+        return StockfishEvaluator(engine)
+    if name == "static":
+        return StaticEvaluator()
+    raise ValueError(f"unknown evaluator {name}")
+
+
+def weights(color, piece_type):
+    '''
+    param:  color bool:       piece color
+    param:  piece_type int:   piece type
+    return: list of the piece's value on each square (a1 first), from white's side
+    '''
+    table = TABLES[piece_type]
+    if color == chess.WHITE:
+        return [VALUES[piece_type] + table[square ^ 56] for square in chess.SQUARES]
+    return [-(VALUES[piece_type] + table[square]) for square in chess.SQUARES]
+
+
+WEIGHTS = [weights(color, piece_type) for color, piece_type in PIECES]
+if numpy is not None:
+    WEIGHTS_FLAT = numpy.array(WEIGHTS, dtype=numpy.int64).reshape(-1)
+
+
+# Classes
+class Evaluator(abc.ABC):
+    '''
+    Scores leaf positions in centipawns from white's side, mates are
+    +/-MATE_SCORE. Leaves come in batches so evaluators that vectorize can.
+    CACHE_LEAVES is set when a leaf costs more than a transposition table lookup,
+    BATCHED when scoring a batch is cheaper than scoring its leaves one by one
+    '''
+    CACHE_LEAVES = True
+    BATCHED      = False
+
+    @abc.abstractmethod
+    def evaluate(self, boards):
+        '''
+        param:  boards list:  leaf positions
+        return: list of scores
+        '''
+
+
+    def rank(self, board, moves, width, depth):
+        '''
+        param:  board Board:  position the moves are played in
+        param:  moves list:   moves to rank
+        param:  width int:    number of best moves wanted
+        param:  depth int:    depth to rank the moves at
+        return: list of (score, move) of the WIDTH best moves, scores from the
+                side to move, or None if the evaluator cannot rank moves
+        '''
+        return None
+
+
+class StockfishEvaluator(Evaluator):
+    '''
+    Depth 0 analysis, one UCI round trip per leaf
+    '''
+    def __init__(self, engine):
+        self.engine = engine
+
+
+    def evaluate(self, boards):
+        limit = chess.engine.Limit(depth=0)
+        return [self.engine.analyse(board, limit)["score"].white().score(mate_score=MATE_SCORE) for board in boards]
+
+
+    def rank(self, board, moves, width, depth):
+        '''
+        One MultiPV analysis restricted to the moves instead of one analysis
+        per move. Returns None if the engine reports fewer lines than asked
+        '''
+        width = min(width, len(moves))
+        infos = self.engine.analyse(board, chess.engine.Limit(depth=depth), multipv=width, root_moves=[chess.Move.from_uci(move) for move in moves])
+        ranked = [(info["score"].relative.score(mate_score=MATE_SCORE), info["pv"][0].uci()) for info in infos if "score" in info and info.get("pv")]
+        if len(ranked) < width:
+            return None
+        return ranked
+
+
+class StaticEvaluator(Evaluator):
+    '''
+    Material and piece-square tables. A batch is scored at once as a matrix
+    product of the leaves' unpacked bitboards with the tables
+    '''
+    CACHE_LEAVES = False
+    BATCHED      = numpy is not None
+
+    def evaluate(self, boards):
+        if numpy is None or len(boards) < BATCH_MIN:
+            scores = [self.score(board) for board in boards]
+        else:
+            # 12 bitboards per leaf, unpacked to one bit per (piece, square)
+            masks  = numpy.array([[board.pieces_mask(piece_type, color) for color, piece_type in PIECES] for board in boards], dtype="<u8")
+            bits   = numpy.unpackbits(masks.view(numpy.uint8), axis=1, bitorder="little")
+            scores = (bits @ WEIGHTS_FLAT).tolist()
+
+        # mated or stalemated leaves, any() stops at the first legal move
+        for i, board in enumerate(boards):
+            if not any(board.generate_legal_moves()):
+                if board.is_check():
+                    scores[i] = -MATE_SCORE if board.turn == chess.WHITE else MATE_SCORE
+                else:
+                    scores[i] = 0
+        return scores
+
+
+    def score(self, board):
+        '''
+        param:  board Board: leaf position
+        return: material and piece-square score of one leaf
+        '''
+        score = 0
+        for (color, piece_type), table in zip(PIECES, WEIGHTS):
+            for square in chess.scan_forward(board.pieces_mask(piece_type, color)):
+                score += table[square]
+        return score
@@ -0,0 +1,158 @@
+# GREG Metrics
+import sys
+import time
+import json
+import bisect
+import collections
+import zmq
+
+# Globals
+LATENCY_BOUNDS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]  # secs
+COUNT_BOUNDS   = [1, 2, 4, 8, 16, 32, 64, 128]
+
+# Functions
+def usage(status):
+    '''
+    param:  status
+    return: None
+    Usage function that exits with STATUS
+    '''
+    print(f"Usage: ./GREGMetrics.py HOST PORT")
+    print(f"    Prints the metrics a GREGServer publishes on HOST:PORT")
+    print(f"    -h         help")
+    exit(status)
+
+
+# Classes
+class Histogram:
+    '''
+    Fixed bucket histogram, observing is a bisect and an increment
+    '''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count  = 0
+        self.sum    = 0
+
+
+    def observe(self, value):
+        '''
+        param:  value float: sample
+        return: None
+        '''
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum   += value
+
+
+    def quantile(self, q):
+        '''
+        param:  q float: quantile in [0, 1]
+        return: upper bound of the bucket holding the quantile, None if empty
+        '''
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+    def snapshot(self):
+        '''
+        param:  None
+        return: dict of the histogram
+        '''
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': [[bound, count] for bound, count in zip(self.bounds + ["inf"], self.counts)]
+        }
+
+
+class Metrics:
+    '''
+    Counters and histograms of a process. Recording is O(1) so it can stay on,
+    rates are computed from counter deltas when a snapshot is taken
+    '''
+    def __init__(self):
+        self.counters   = collections.Counter()
+        self.histograms = dict()
+        self.last       = collections.Counter()
+        self.last_time  = time.time()
+
+
+    def histogram(self, name, bounds):
+        '''
+        param:  name string:  histogram name
+        param:  bounds list:  upper bounds of the buckets
+        return: None
+        Registers a histogram
+        '''
+        self.histograms[name] = Histogram(bounds)
+
+
+    def incr(self, name, n=1):
+        '''
+        param:  name string:  counter name
+        param:  n int:        increment
+        return: None
+        '''
+        self.counters[name] += n
+
+
+    def observe(self, name, value):
+        '''
+        param:  name string:  registered histogram name
+        param:  value float:  sample
+        return: None
+        '''
+        self.histograms[name].observe(value)
+
+
+    def snapshot(self, gauges=None):
+        '''
+        param:  gauges dict:  current values to report alongside the counters
+        return: dict of every metric
+        Takes a snapshot, rates are per second since the previous snapshot
+        '''
+        now     = time.time()
+        elapsed = max(now - self.last_time, 1e-3)
+        rates   = {name: (count - self.last[name]) / elapsed for name, count in self.counters.items()}
+
+        self.last      = self.counters.copy()
+        self.last_time = now
+        return {
+            'time': now,
+            'gauges': gauges or dict(),
+            'counters': dict(self.counters),
+            'rates': rates,
+            'histograms': {name: hist.snapshot() for name, hist in self.histograms.items()}
+        }
+
+
+# Main Execution
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] == "-h":
+        usage(0 if len(sys.argv) > 1 and sys.argv[1] == "-h" else 1)
+
+    host, port = sys.argv[1], int(sys.argv[2])
+
+    # subscribe to the snapshots, load reports for other servers have their own topic
+    context = zmq.Context()
+    socket  = context.socket(zmq.SUB)
+    socket.connect(f"tcp://{host}:{port}")
+    socket.setsockopt(zmq.SUBSCRIBE, b"{")
+
+    while True:
+        print(json.dumps(json.loads(socket.recv()), indent=2), flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# GREG Protocol
+import json
+import struct
+import chess
+
+# Globals
+JSON   = "json"
+BINARY = "binary"
+
+# binary message types, JSON messages always start with '{' (0x7b)
+WORKER_REQUEST = 1
+HEARTBEAT      = 2
+POSITION       = 3
+TASK           = 4
+RESULT         = 5
+CANCEL         = 6
+REQUEST        = 7
+REPLY          = 8
+RESYNC         = 9
+RESET          = 10
+SPLIT          = 11
+MOVE           = 12
+
+NO_MOVE    = 0xffff
+NO_ID      = 0xffffffff
+NO_SCORE   = -2**31
+SCORE_MAX  = 2**31 - 1
+
+HEADER  = struct.Struct("!B")
+DEPTH   = struct.Struct("!BB")
+SLOTS   = struct.Struct("!BHH")     # type, batches held at once, engines
+BATCHES = struct.Struct("!BI")
+TASKS   = struct.Struct("!BIIB")    # type, batch, movetime, split allowed
+RESULTS = struct.Struct("!BHiI")
+SPLITS  = struct.Struct("!BHBB")    # type, root move, depth, number of moves; moves and board follow
+REQUESTS = struct.Struct("!BBII")
+REPLIES  = struct.Struct("!BHiI")
+HEARTBEATS = struct.Struct("!BIIQQ") # type, engine restarts, nodes/sec, shared cache lookups and hits
+PROGRESS = struct.Struct("!III")    # batch, nodes, root moves left; repeated after a heartbeat
+MOVES    = struct.Struct("!BH")     # type, worker port of the broker to move to; its host follows
+
+SQUARES    = {name: square for square, name in enumerate(chess.SQUARE_NAMES)}
+PROMOTIONS = {chess.piece_symbol(piece): piece for piece in (chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN)}
+
+# Functions
+def pack_move(uci):
+    '''
+    param:  uci string: move in uci notation, or None
+    return: int move packed in 16 bits (from | to << 6 | promotion << 12)
+    '''
+    if uci is None:
+        return NO_MOVE
+    if uci == "0000":
+        return 0
+    promotion = PROMOTIONS[uci[4]] if len(uci) > 4 else 0
+    return SQUARES[uci[0:2]] | SQUARES[uci[2:4]] << 6 | promotion << 12
+
+
+def unpack_move(packed):
+    '''
+    param:  packed int: move from pack_move
+    return: move in uci notation, or None
+    '''
+    if packed == NO_MOVE:
+        return None
+    if packed == 0:
+        return "0000"
+    uci = chess.SQUARE_NAMES[packed & 0x3f] + chess.SQUARE_NAMES[packed >> 6 & 0x3f]
+    if packed >> 12:
+        uci += chess.piece_symbol(packed >> 12)
+    return uci
+
+
+def pack_score(score):
+    '''
+    param:  score int/float: score, -inf for no score
+    return: int that fits an int32
+    '''
+    if score == float("-inf"):
+        return NO_SCORE
+    return max(NO_SCORE + 1, min(SCORE_MAX, int(score)))
+
+
+def unpack_score(score):
+    '''
+    param:  score int: score from pack_score
+    return: score, -inf for no score
+    '''
+    if score == NO_SCORE:
+        return float("-inf")
+    return score
+
+
+def is_binary(data):
+    '''
+    param:  data bytes: raw message
+    return: True if message uses the binary framing
+    '''
+    return len(data) > 0 and data[0] != ord("{")
+
+
+def encode(message, codec=JSON):
+    '''
+    param:  message dict:   message in the JSON layout
+    param:  codec string:   JSON or BINARY
+    return: bytes to send
+    Encodes a message. In BINARY a task carries only its moves and batch id,
+    the board and depth go once per job in a Position message
+    '''
+    if codec == JSON:
+        return json.dumps(message).encode()
+
+    msg_type = message.get("type")
+    if msg_type == "WorkerRequest":
+        if message.get("status") == "Resync":
+            return BATCHES.pack(RESYNC, message["batch"])
+        return SLOTS.pack(WORKER_REQUEST, message.get("slots", 1), message.get("engines", message.get("slots", 1)))
+    if msg_type == "<3":
+        probes, hits = message.get("cache", (0, 0))
+        return HEARTBEATS.pack(HEARTBEAT, message.get("restarts", 0), message.get("nps", 0), probes, hits) + b"".join(PROGRESS.pack(batch, nodes & 0xffffffff, left) for batch, nodes, left in message.get("progress", []))
+    if msg_type == "Cancel":
+        return HEADER.pack(CANCEL)
+    if msg_type == "Reset":
+        return HEADER.pack(RESET)
+    if msg_type == "Move":
+        return MOVES.pack(MOVE, message["port"]) + message["host"].encode()
+    if msg_type == "Position":
+        return DEPTH.pack(POSITION, message["depth"]) + message["board"].encode()
+    if msg_type == "Split":
+        moves = message["listOfMoves"]
+        return SPLITS.pack(SPLIT, pack_move(message["move"]), message["depth"], len(moves)) + struct.pack(f"!{len(moves)}H", *map(pack_move, moves)) + message["board"].encode()
+    if msg_type == "WorkerResult":
+        return RESULTS.pack(RESULT, pack_move(message["move"]), pack_score(message["score"]), message["batch"])
+    if "listOfMoves" in message:
+        moves = message["listOfMoves"]
+        return TASKS.pack(TASK, message["batch"], message.get("movetime", 0), message.get("split", False)) + struct.pack(f"!{len(moves)}H", *map(pack_move, moves))
+    if "board" in message:
+        return REQUESTS.pack(REQUEST, message["depth"], message.get("id", NO_ID), message.get("movetime", 0)) + message["board"].encode()
+    if "move" in message:
+        return REPLIES.pack(REPLY, pack_move(message["move"]), pack_score(message["score"]), message.get("id", NO_ID))
+    raise ValueError(f"cannot encode {message}")
+
+
+def decode(data):
+    '''
+    param:  data bytes: raw message in either framing
+    return: message dict in the JSON layout
+    '''
+    if not is_binary(data):
+        return json.loads(data)
+
+    msg_type = data[0]
+    if msg_type == WORKER_REQUEST:
+        _, slots, engines = SLOTS.unpack(data)
+        return {"type":"WorkerRequest", "status":"Ready", "slots":slots, "engines":engines}
+    if msg_type == RESYNC:
+        return {"type":"WorkerRequest", "status":"Resync", "batch":BATCHES.unpack(data)[1]}
+    if msg_type == HEARTBEAT:
+        message = {"type":"<3"}
+        _, restarts, nps, probes, hits = HEARTBEATS.unpack_from(data)
+        if restarts:
+            message["restarts"] = restarts
+        if nps:
+            message["nps"] = nps
+        if probes:
+            message["cache"] = [probes, hits]
+        if len(data) > HEARTBEATS.size:
+            message["progress"] = [list(progress) for progress in PROGRESS.iter_unpack(data[HEARTBEATS.size:])]
+        return message
+    if msg_type == CANCEL:
+        return {"type":"Cancel"}
+    if msg_type == RESET:
+        return {"type":"Reset"}
+    if msg_type == MOVE:
+        return {"type":"Move", "port":MOVES.unpack_from(data)[1], "host":data[MOVES.size:].decode()}
+    if msg_type == POSITION:
+        return {"type":"Position", "depth":data[1], "board":data[2:].decode()}
+    if msg_type == TASK:
+        _, batch, movetime, split = TASKS.unpack_from(data)
+        count = (len(data) - TASKS.size) // 2
+        moves = struct.unpack_from(f"!{count}H", data, TASKS.size)
+        message = {"listOfMoves":[unpack_move(m) for m in moves], "batch":batch}
+        if movetime:
+            message["movetime"] = movetime
+        if split:
+            message["split"] = True
+        return message
+    if msg_type == SPLIT:
+        _, move, depth, count = SPLITS.unpack_from(data)
+        moves = struct.unpack_from(f"!{count}H", data, SPLITS.size)
+        board = data[SPLITS.size + 2*count:].decode()
+        return {"type":"Split", "move":unpack_move(move), "depth":depth, "listOfMoves":[unpack_move(m) for m in moves], "board":board}
+    if msg_type == RESULT:
+        _, move, score, batch = RESULTS.unpack(data)
+        return {"type":"WorkerResult", "move":unpack_move(move), "score":unpack_score(score), "batch":batch}
+    if msg_type == REQUEST:
+        _, depth, request_id, movetime = REQUESTS.unpack_from(data)
+        message = {"depth":depth, "board":data[REQUESTS.size:].decode()}
+        if movetime:
+            message["movetime"] = movetime
+    elif msg_type == REPLY:
+        _, move, score, request_id = REPLIES.unpack(data)
+        message = {"move":unpack_move(move), "score":unpack_score(score)}
+    else:
+        raise ValueError(f"unknown message type {msg_type}")
+
+    # requests and replies carry an id when the client pipelines
+    if request_id != NO_ID:
+        message["id"] = request_id
+    return message
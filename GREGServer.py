@@ -6,12 +6,14 @@ import chess
 import signal
 import sys
 import json
+import collections
+import heapq
+import math
 import socket
-from threading import Lock
-
-# Globals
-NSERVER = "catalog.cse.nd.edu"
-NPORT   = 9097
+from threading import Lock, Thread
+import GREGProtocol
+import GREGMetrics
+import GREGDiscovery
 
 # Functions
 def usage(status):
@@ -23,25 +25,462 @@ def usage(status):
     print(f"Usage: ./GREGServer.py [options]")
     print(f"    -n NAME    Add unique name")
     print(f"    -d         Turn debugging on")
+    print(f"    -c MB      Result cache size in MB (default=16, 0 to disable)")
+    print(f"    -m PORT    Port to publish metrics on (default=random)")
+    print(f"    -p PLIES   Plies idle workers search ahead of the last answer (default=2, 0 to disable)")
+    print(f"    -D SPEC    Discovery backend (default={GREGDiscovery.DEFAULT})")
+    print(f"               catalog:HOST:PORT, static:HOST:CPORT:WPORT or file:PATH")
     print(f"    -h         help")
     exit(status)
 
 
+def move_cost(board, move):
+    '''
+    param:  board Board:    position the root move is played in
+    param:  move string:    root move
+    return: estimated cost of searching the move, the number of replies it leaves
+    Every search of a root move starts by scoring the opponent's replies, so
+    quiet moves cost more than checks and mates cost next to nothing
+    '''
+    board.push_uci(move)
+    cost = max(1, board.legal_moves.count())
+    board.pop()
+    return cost
+
+
 # Classes 
+class WorkQueue:
+    '''
+    Fair task queue: one deque of tasks per job, grouped by the client that
+    owns the job. Clients are served round robin, and so are the jobs of a
+    client, so neither one client's root moves nor a client pipelining many
+    positions can starve clients that arrive later. All operations are O(1).
+    '''
+    def __init__(self):
+        self.groups = collections.OrderedDict()
+        self.group_of = dict()
+        self.length = 0
+
+
+    def __len__(self):
+        return self.length
+
+
+    def queued(self, job_id):
+        '''
+        param:  job_id string: job to count the tasks of
+        return: number of tasks of the job in the queue
+        '''
+        group = self.group_of.get(job_id)
+        if group is None:
+            return 0
+        return len(self.groups[group][job_id])
+
+
+    def push(self, task, group, front=False):
+        '''
+        param:  task tuple:     task to queue, (job id, board, move, depth, cost)
+        param:  group string:   client owning the task's job
+        param:  front bool:     put task at the front of its job's queue
+        return: None
+        Adds a task to its job's queue
+        '''
+        job_id = task[0]
+        self.group_of[job_id] = group
+
+        jobs = self.groups.get(group)
+        if jobs is None:
+            jobs = self.groups[group] = collections.OrderedDict()
+        queue = jobs.get(job_id)
+        if queue is None:
+            queue = jobs[job_id] = collections.deque()
+
+        if front:
+            queue.appendleft(task)
+        else:
+            queue.append(task)
+        self.length += 1
+
+
+    def pop(self):
+        '''
+        param:  None
+        return: task tuple
+        Pops the next task in round robin order
+        '''
+        return self.pop_batch(1)[0]
+
+
+    def pop_batch(self, size, budget=None):
+        '''
+        param:  size int:     max number of tasks to pop
+        param:  budget float: total cost of the tasks to aim for, None for no limit
+        return: list of tasks
+        Pops up to SIZE tasks of the next job in round robin order, all
+        searching the same board at the same depth. At least one task is
+        popped whatever its cost
+        '''
+        group, jobs = next(iter(self.groups.items()))
+        job_id, queue = next(iter(jobs.items()))
+        first = queue.popleft()
+        batch = [first]
+        cost  = first[4]
+        while queue and len(batch) < size and queue[0][1] is first[1] and queue[0][3] == first[3]:
+            if budget is not None and cost >= budget:
+                break
+            cost += queue[0][4]
+            batch.append(queue.popleft())
+        self.length -= len(batch)
+
+        # job and client go to the back of the line
+        if queue:
+            jobs.move_to_end(job_id)
+        else:
+            del jobs[job_id]
+            del self.group_of[job_id]
+        if jobs:
+            self.groups.move_to_end(group)
+        else:
+            del self.groups[group]
+        return batch
+
+
+    def peek(self):
+        '''
+        param:  None
+        return: task tuple
+        Returns the task pop would return without removing it
+        '''
+        jobs = next(iter(self.groups.values()))
+        return next(iter(jobs.values()))[0]
+
+
+    def skip(self):
+        '''
+        param:  None
+        return: None
+        Sends the next job and its client to the back of the line without
+        popping anything
+        '''
+        group, jobs = next(iter(self.groups.items()))
+        jobs.move_to_end(next(iter(jobs)))
+        self.groups.move_to_end(group)
+
+
+    def drop(self, job_id):
+        '''
+        param:  job_id string: job whose tasks are dropped
+        return: list of the dropped tasks
+        Removes every queued task of a job
+        '''
+        group = self.group_of.pop(job_id, None)
+        if group is None:
+            return []
+
+        jobs  = self.groups[group]
+        queue = jobs.pop(job_id)
+        self.length -= len(queue)
+        if not jobs:
+            del self.groups[group]
+        return list(queue)
+
+
+class ExpiryIndex:
+    '''
+    Deadline index for liveness tracking. Heartbeats only overwrite a deadline
+    (O(1)); the heap holds one live entry per ident and a refreshed entry is
+    pushed back with its newer deadline when it reaches the top, so purges
+    cost O(log n) per expired or refreshed ident.
+    '''
+    def __init__(self):
+        self.deadlines = dict()
+        self.entries = dict()
+        self.heap = []
+        self.seq = 0
+
+
+    def push(self, ident, deadline):
+        '''
+        param:  ident string:     id to track
+        param:  deadline float:   time at which ident expires
+        return: None
+        Pushes the live heap entry of an ident, older entries become stale
+        '''
+        self.seq += 1
+        self.entries[ident] = self.seq
+        heapq.heappush(self.heap, (deadline, self.seq, ident))
+
+
+    def __len__(self):
+        return len(self.deadlines)
+
+
+    def touch(self, ident, deadline):
+        '''
+        param:  ident string:     id to track
+        param:  deadline float:   time at which ident expires
+        return: None
+        Sets (or pushes back) the deadline of an ident
+        '''
+        if ident not in self.deadlines:
+            self.push(ident, deadline)
+        self.deadlines[ident] = deadline
+
+
+    def forget(self, ident):
+        '''
+        param:  ident string: id to stop tracking
+        return: None
+        Stops tracking an ident, its heap entry is dropped lazily
+        '''
+        self.deadlines.pop(ident, None)
+        self.entries.pop(ident, None)
+
+
+    def expired(self, now):
+        '''
+        param:  now float: current time
+        return: list of idents whose deadline has passed
+        Pops every expired ident from the index
+        '''
+        expired = []
+        while self.heap and self.heap[0][0] < now:
+            deadline, seq, ident = heapq.heappop(self.heap)
+
+            # forgotten or superseded, entry is stale
+            if self.entries.get(ident) != seq:
+                continue
+
+            # refreshed since pushed, re-queue with the newer deadline
+            current = self.deadlines[ident]
+            if current > deadline:
+                self.push(ident, current)
+                continue
+
+            self.forget(ident)
+            expired.append(ident)
+        return expired
+
+
+class IdleIndex:
+    '''
+    Index of the workers with a free slot ordered by their throughput to
+    spare. Every update pushes a new heap entry and leaves the older ones
+    stale, stale entries are dropped when they reach the top, so updates and
+    picks cost O(log n). Workers with an engine free are kept in a second
+    heap, ties go to the worker updated longest ago.
+    '''
+    def __init__(self):
+        self.entries = dict()
+        self.heap = []
+        self.engine_heap = []
+        self.seq = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, ident):
+        return ident in self.entries
+
+
+    def __iter__(self):
+        return iter(self.entries)
+
+
+    def update(self, ident, spare, engine):
+        '''
+        param:  ident string:   worker with a free slot
+        param:  spare float:    throughput it has to spare
+        param:  engine bool:    it has an engine free, not just a slot
+        return: None
+        Adds or re-ranks a worker, its older entries become stale
+        '''
+        self.seq += 1
+        self.entries[ident] = self.seq
+        heapq.heappush(self.heap, (-spare, self.seq, ident))
+        if engine:
+            heapq.heappush(self.engine_heap, (-spare, self.seq, ident))
+
+        # stale entries that never reach the top are dropped now and then
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = self.live(self.heap)
+            self.engine_heap = self.live(self.engine_heap)
+
+
+    def forget(self, ident):
+        '''
+        param:  ident string: worker without a free slot anymore
+        return: None
+        Removes a worker, its heap entries are dropped lazily
+        '''
+        self.entries.pop(ident, None)
+
+
+    def live(self, heap):
+        '''
+        param:  heap list:  one of the heaps
+        return: heap of its entries that are not stale
+        '''
+        heap = [entry for entry in heap if self.entries.get(entry[2]) == entry[1]]
+        heapq.heapify(heap)
+        return heap
+
+
+    def top(self, heap):
+        '''
+        param:  heap list:  one of the heaps
+        return: top entry that is not stale, None if the heap has none
+        '''
+        while heap and self.entries.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+
+    def best(self, engine=False, other_than=None):
+        '''
+        param:  engine bool:        only workers with an engine free
+        param:  other_than string:  worker not to pick, None for any
+        return: worker with the most throughput to spare, None if there is none
+        '''
+        heap  = self.engine_heap if engine else self.heap
+        entry = self.top(heap)
+        if entry is None:
+            return None
+        if entry[2] != other_than:
+            return entry[2]
+
+        # the excluded worker is set aside to look one entry further
+        heapq.heappop(heap)
+        second = self.top(heap)
+        heapq.heappush(heap, entry)
+        return None if second is None else second[2]
+
+
+class ResultCache:
+    '''
+    Bounded LRU of finished searches keyed by (normalized FEN, depth).
+    Memory is accounted with an estimated size per entry and least recently
+    used entries are evicted once the cap is reached.
+    '''
+    ENTRY_OVERHEAD = 240 # bytes of dict node, tuples and ints per entry
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    @staticmethod
+    def key(board, depth):
+        '''
+        param:  board Board: position searched
+        param:  depth int:   depth of the search
+        return: hashable key
+        Normalizes a position: move counters are dropped, en passant kept only if legal
+        '''
+        return (board.epd(), depth)
+
+
+    def size(self, key, value):
+        return sys.getsizeof(key[0]) + sys.getsizeof(value[0]) + self.ENTRY_OVERHEAD
+
+
+    def get(self, key):
+        '''
+        param:  key tuple: key from ResultCache.key
+        return: (move, score) or None
+        Looks up a result and marks it recently used
+        '''
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+
+    def put(self, key, move, score):
+        '''
+        param:  key tuple:   key from ResultCache.key
+        param:  move string: best move of the search
+        param:  score int:   score of the best move
+        return: None
+        Stores a result, evicting least recently used entries past the cap
+        '''
+        value = (move, score)
+        size  = self.size(key, value)
+        if size > self.max_bytes:
+            return
+
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= self.size(key, old)
+
+        self.entries[key] = value
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            old_key, old = self.entries.popitem(last=False)
+            self.bytes -= self.size(old_key, old)
+            self.evictions += 1
+
+
+    def stats(self):
+        '''
+        param:  None
+        return: dict of cache statistics
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
 class ChessServer:
     HEARTBEAT_LIVENESS = 3
     HEARTBEAT_INTERVAL = 5000 # msecs
     HEARTBEAT_EXPIRY = HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
     POLL_TIMEOUT = 5000
+    BATCH_TARGET = 0.5  # secs of work to aim for per batch
+    BATCH_MAX = 8
+    RATE_WEIGHT = 0.3   # EWMA weight of the newest throughput sample
+    MATE_SCORE = 99000  # scores above this are a mate found by the worker
+    POSITIONS = 16      # job positions remembered per binary worker, must not exceed the worker's
+    METRICS_INTERVAL = 5 # secs between metrics snapshots
+    PONDER = b"ponder"  # owner of speculative jobs
+    STRAGGLER_AGE = 1.0 # secs a batch is outstanding before it can be duplicated
+    STRAGGLER_FACTOR = 3 # times the expected time of a batch before it is duplicated
+    STRAGGLER_INTERVAL = 0.25 # secs between looks for stragglers
+    LEND_INTERVAL = 1   # secs between load reports, and looks for other servers of the service to lend idle workers to
+    LEND_KEEP = 1       # workers kept however idle, for the next request
+    PEER_INTERVAL = 5   # secs between lookups of the other servers of the service
+    LOAD = b"load "     # topic of load reports on the metrics socket, snapshots start with '{'
 
     heartbeat_at = None
 
     #########################
     #    Class Functions    #
     #########################
-    def __init__(self, debug=False, name=""):
+    def __init__(self, debug=False, name="", cache_mb=16, metrics_port=0, discovery=GREGDiscovery.DEFAULT, ponder=2):
         self.debug   = debug
         self.name    = name
+        self.ponder_plies = ponder
+        self.discovery = GREGDiscovery.create(discovery)
 
         self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
 
@@ -50,9 +489,26 @@ class ChessServer:
         self.worker  = self.context.socket(zmq.ROUTER)
         self.client  = self.context.socket(zmq.ROUTER)
         
-        # bind to random port
-        self.w_port  = self.worker.bind_to_random_port(f"tcp://*")
-        self.c_port  = self.client.bind_to_random_port(f"tcp://*")
+        # bind to the discovery's ports, random if it has none
+        self.w_port  = self.bind(self.worker, f"{self.name}chessWorker")
+        self.c_port  = self.bind(self.client, f"{self.name}chessClient")
+
+        # metrics are published as JSON snapshots
+        self.metrics_socket = self.context.socket(zmq.PUB)
+        if metrics_port:
+            self.metrics_socket.bind(f"tcp://*:{metrics_port}")
+            self.m_port = metrics_port
+        else:
+            self.m_port = self.metrics_socket.bind_to_random_port(f"tcp://*")
+        self.printg(f"metrics on port {self.m_port}", True)
+
+        # other servers of the service, their load reports tell who needs workers
+        self.broker_id = f"{socket.gethostname()}:{self.w_port}"
+        self.peers  = dict()
+        self.peer_entries = dict()
+        self.lend_at = 0
+        self.load_at = 0
+        Thread(target=self.watch_peers, args=(GREGDiscovery.create(discovery),), daemon=True).start()
 
         # set up name server pinging
         signal.setitimer(signal.ITIMER_REAL, 1, 60)
@@ -60,11 +516,34 @@ class ChessServer:
 
         # worker structures
         self.workers = dict()
-        self.waiting = []
-        self.work_queue = []
+        self.worker_expiry = ExpiryIndex()
+        self.idle    = IdleIndex()
+        self.work_queue = WorkQueue()
+        self.ponder_queue = WorkQueue()
 
         # client structures
         self.clients = dict()
+        self.client_expiry = ExpiryIndex()
+
+        # job structures, one job per distinct in-flight search
+        self.jobs = dict()
+        self.inflight = dict()
+        self.deadlines = []
+        self.pondering = set()
+        self.stragglers_at = 0
+        self.next_job = 0
+        self.next_batch = 0
+
+        # finished searches
+        self.cache = ResultCache(cache_mb * 1024 * 1024)
+
+        # metrics
+        self.metrics = GREGMetrics.Metrics()
+        self.metrics.histogram('job_latency', GREGMetrics.LATENCY_BOUNDS)
+        self.metrics.histogram('job_fanout', GREGMetrics.COUNT_BOUNDS)
+        self.metrics.histogram('batch_size', GREGMetrics.COUNT_BOUNDS)
+        self.metrics.histogram('straggler_saved', GREGMetrics.LATENCY_BOUNDS)
+        self.metrics_at = time.time() + self.METRICS_INTERVAL
 
         
     def printg(self, msg, alwaysPrint=False):
@@ -81,124 +560,911 @@ class ChessServer:
                 print(msg)
 
 
-    def add_task(self, task):
+    def bind(self, sock, service):
+        '''
+        param:  sock Socket:      socket to bind
+        param:  service string:   service served on the socket
+        return: port bound
+        '''
+        port = self.discovery.bind_port(service)
+        if port:
+            sock.bind(f"tcp://*:{port}")
+            return port
+        return sock.bind_to_random_port(f"tcp://*")
+
+
+    def add_task(self, task, front=False):
         '''
-        param:  task string: task to be added to the work queue
+        param:  task tuple: task to be added to the work queue
+        param:  front bool: requeued task that should go first
         return: None
-        wrapper function to add task
+        wrapper function to add task, queued under the client owning its job.
+        Tasks of speculative jobs wait in their own queue
+        '''
+        job   = self.jobs[task[0]]
+        queue = self.ponder_queue if job['ponder'] else self.work_queue
+        queue.push(task, job['owner'], front)
+
+
+    def update_idle(self, worker_id):
         '''
-        self.work_queue.append(task)
+        param:  worker_id string: worker to update
+        return: None
+        Keeps the idle index in sync, a worker is idle while it has a free slot
+        and ranked by the nodes/sec it reports scaled by its free slots
+        '''
+        info = self.workers.get(worker_id)
+        if info is not None and len(info['batches']) < info['slots']:
+            spare = info['nps'] * (info['slots'] - len(info['batches'])) / info['slots']
+            self.idle.update(worker_id, spare, len(info['batches']) < info['engines'])
+        else:
+            self.idle.forget(worker_id)
 
-    def worker_req(self, worker_id):
+    def worker_req(self, worker_id, codec=GREGProtocol.JSON, slots=1, engines=None):
         '''
         param:  worker_id string: worker id that has the req
+        param:  codec string:     wire codec the worker asked for
+        param:  slots int:        number of batches the worker holds at once
+        param:  engines int:      number of batches it searches at once, slots if None
         return: None
-        wrapper to add ready worker to dict
+        wrapper to add ready worker to dict, a worker says hello with nothing
+        in flight and no positions
         '''
         if worker_id in self.workers:
-            # task not returned sadness
-            task = self.workers[worker_id]['task']
-            if task != '':
-                self.add_task(task)
-                self.printg(task)
-    
-        self.add_worker(worker_id, available=True)
+            # tasks not returned sadness
+            self.metrics.incr('tasks_requeued_unreturned', self.requeue(worker_id))
+        else:
+            self.add_worker(worker_id)
 
-    
-    def returned_result(self, worker_id, client_id, move, score):
+        info = self.workers[worker_id]
+        info['codec'] = codec
+        info['slots'] = slots
+        info['engines'] = slots if engines is None else engines
+        info['positions'].clear()
+        self.update_idle(worker_id)
+
+
+    def worker_resync(self, worker_id, batch_id):
+        '''
+        param:  worker_id string: worker that lost the position of a batch
+        param:  batch_id int:     batch it could not search
+        return: None
+        Requeues the batch, its position is sent again with it
+        '''
+        self.workers[worker_id]['positions'].clear()
+        self.metrics.incr('tasks_requeued_resync', self.requeue(worker_id, [batch_id]))
+
+
+    def reset_worker(self, worker_id, codec):
+        '''
+        param:  worker_id string: worker the server has no record of
+        param:  codec string:     codec the worker talks in
+        return: None
+        A worker declared dead is still talking, ask it to drop its work and
+        say hello again
+        '''
+        self.metrics.incr('workers_reset')
+        msg = GREGProtocol.encode({"type":"Reset"}, codec)
+        self.worker.send_multipart([worker_id, b"", msg])
+
+
+    def requeue(self, worker_id, batch_ids=None):
+        '''
+        param:  worker_id string: worker whose tasks are requeued
+        param:  batch_ids list:   batches to take back, all of them by default
+        return: number of tasks requeued
+        Puts a worker's unfinished batches back at the front of the queue
+        '''
+        if batch_ids is None:
+            batch_ids = list(self.workers[worker_id]['batches'])
+
+        count = 0
+        for batch_id in batch_ids:
+            batch = self.take_batch(worker_id, batch_id)
+
+            # lost to its duplicate, or its duplicate is still searching
+            if batch is None or batch['won'] is not None or self.twin_outstanding(batch):
+                continue
+            for task in reversed(batch['tasks']):
+                if task[0] in self.jobs:
+                    self.add_task(task, front=True)
+                    self.printg(task)
+                    count += 1
+        return count
+
+
+    def twin_outstanding(self, batch):
+        '''
+        param:  batch dict: batch taken back from a worker
+        return: True if the batch was duplicated and the copy is still out
+        '''
+        if batch['twin'] is None:
+            return False
+        worker_id, twin_id = batch['twin']
+        info = self.workers.get(worker_id)
+        if info is None or twin_id not in info['batches']:
+            return False
+
+        # the copy is on its own now
+        info['batches'][twin_id]['twin'] = None
+        return True
+
+
+    def take_batch(self, worker_id, batch_id):
+        '''
+        param:  worker_id string: worker whose batch is taken back
+        param:  batch_id int:     batch to take
+        return: batch dict, None if the worker no longer holds it
+        Frees the batch's slot and removes the worker from the batch's job
+        '''
+        batch = self.workers[worker_id]['batches'].pop(batch_id, None)
+        if batch is not None:
+            job = self.jobs.get(batch['tasks'][0][0])
+            if job is not None:
+                job['workers'].discard((worker_id, batch_id))
+            self.update_idle(worker_id)
+        return batch
+
+
+    def batch_size(self, worker_id, depth, queued, timed=False):
+        '''
+        param:  worker_id string: worker the batch goes to
+        param:  depth int:        depth of the batch's search
+        param:  queued int:       tasks waiting in the batch's queue, only the
+                                  job's own for a timed batch
+        param:  timed bool:       the batch's job has a deadline
+        return: tuple of (max number of root moves, max total cost) to pack in
+                one task, the cost is None for no limit
+        Sizes a batch from the worker's observed cost/sec at this depth and
+        from how many tasks each idle worker would get. Timed searches take
+        their whole budget whatever their size, so they are spread over the
+        idle workers right away
+        '''
+        if timed:
+            return math.ceil(queued / len(self.idle)), None
+
+        rate = self.workers[worker_id]['rate'].get(depth)
+        if rate is None:
+            return 1, None
+
+        share = math.ceil(queued / (len(self.idle) + 1))
+        return max(1, min(self.BATCH_MAX, share)), rate * self.BATCH_TARGET
+
+
+    def dispatch(self):
+        '''
+        param:  None
+        return: None
+        Sends batches of queued tasks to idle workers, jobs served round robin.
+        Workers left idle after that take over straggling batches, and only
+        then do speculative tasks go to the workers still idle
+        '''
+        self.dispatch_queue(self.work_queue)
+        if len(self.work_queue) == 0 and len(self.idle) > 0 and time.time() >= self.stragglers_at:
+            self.duplicate_stragglers()
+        self.dispatch_queue(self.ponder_queue)
+
+
+    def dispatch_queue(self, queue):
+        '''
+        param:  queue WorkQueue:  queue to send tasks of
+        return: None
+        Sends batches of a queue's tasks to idle workers, jobs served round
+        robin. Timed jobs wait for a free engine while the jobs behind them go ahead
+        '''
+        held = set()
+        while len(queue) > 0 and len(self.idle) > 0:
+            job_id, board, move, depth, cost = queue.peek()
+            if job_id not in self.jobs:
+                queue.pop()
+                continue
+
+            # the most expensive root moves left go to the fastest worker, timed
+            # ones only to a free engine, their budget runs from when they arrive
+            job   = self.jobs[job_id]
+            timed = job['deadline'] is not None
+            worker = self.fastest_idle(timed)
+            if worker is None:
+                # every engine is busy, the jobs behind may still take a queued slot
+                held.add(job_id)
+                if len(held) >= len(queue.group_of):
+                    break
+                queue.skip()
+                continue
+            queued = queue.queued(job_id) if timed else len(queue)
+            batch = queue.pop_batch(*self.batch_size(worker, depth, queued, timed))
+
+            # idle workers would be left over, the worker may hand back subtrees
+            split = not timed and not job['ponder'] and len(queue) < len(self.idle) - 1
+            self.send_batch(worker, batch, split)
+
+
+    def fastest_idle(self, engine=False, other_than=None):
+        '''
+        param:  engine bool:        only workers with an engine free, not just a slot
+        param:  other_than string:  worker not to pick, None for any
+        return: idle worker with the most throughput to spare, None if there is none
+        Workers are ranked by the nodes/sec they report scaled by their free
+        slots, ties (workers that did not report yet) go round robin
+        '''
+        return self.idle.best(engine, other_than)
+
+
+    def send_batch(self, worker, tasks, split=False):
+        '''
+        param:  worker string:  worker with a free slot
+        param:  tasks list:     tasks of one job, same board and depth
+        param:  split bool:     worker may hand subtrees back
+        return: id of the batch sent
+        Sends a batch of tasks to a worker, binary workers get the job's
+        position first if they do not hold it
+        '''
+        job_id, board, move, depth, cost = tasks[0]
+        job   = self.jobs[job_id]
+        timed = job['deadline'] is not None
+        info  = self.workers[worker]
+        moves = [task[2] for task in tasks]
+
+        self.next_batch += 1
+        batch_id = self.next_batch
+
+        if info['codec'] == GREGProtocol.BINARY:
+            # position goes once per job, tasks only carry moves
+            positions = info['positions']
+            if job_id not in positions:
+                msg = GREGProtocol.encode({"type":"Position", "board":board.fen(), "depth":depth}, GREGProtocol.BINARY)
+                self.worker.send_multipart([bytes(worker), job_id, msg])
+                positions[job_id] = True
+                if len(positions) > self.POSITIONS:
+                    positions.popitem(last=False)
+            positions.move_to_end(job_id)
+            task = {"listOfMoves":moves, "batch":batch_id}
+        else:
+            task = {"listOfMoves":moves, "board":board.fen(),"depth":depth, "batch":batch_id}
+
+        if split:
+            task["split"] = True
+
+        # the worker gets what is left of the job's time
+        if timed:
+            task["movetime"] = max(1, int((job['deadline'] - time.time()) * 1000))
+        msg = GREGProtocol.encode(task, info['codec'])
+
+        self.printg(msg)
+        info['batches'][batch_id] = {'tasks': tasks, 'sent': time.time(), 'timed': timed, 'progress': None, 'twin': None, 'won': None}
+        job['workers'].add((worker, batch_id))
+        job['batches'] += 1
+        self.metrics.incr('batches_sent')
+        self.metrics.incr('tasks_sent', len(tasks))
+        self.metrics.observe('batch_size', len(tasks))
+        self.worker.send_multipart([bytes(worker), job_id, msg])
+        self.update_idle(worker)
+        return batch_id
+
+
+    def duplicate_stragglers(self):
+        '''
+        param:  None
+        return: None
+        Sends copies of the longest outstanding batches of running jobs to
+        idle workers, the first of the two results to come back is used
+        '''
+        self.stragglers_at = time.time() + self.STRAGGLER_INTERVAL
+        now = time.time()
+        stragglers = []
+        for job in self.jobs.values():
+            if job['ponder'] or job['deadline'] is not None:
+                continue
+            for worker, batch_id in job['workers']:
+                batch = self.workers[worker]['batches'][batch_id]
+                if batch['twin'] is None and now - batch['sent'] > self.straggler_age(worker, batch):
+                    stragglers.append((batch['sent'], worker, batch_id))
+
+        for sent, worker, batch_id in sorted(stragglers):
+            # a copy on the worker that is late would not help
+            idle = self.fastest_idle(other_than=worker)
+            if idle is None:
+                break
+
+            batch = self.workers[worker]['batches'][batch_id]
+            twin  = self.send_batch(idle, batch['tasks'])
+            batch['twin'] = (idle, twin)
+            self.workers[idle]['batches'][twin]['twin'] = (worker, batch_id)
+            self.metrics.incr('stragglers_duplicated')
+            self.printg(f"batch {batch_id} of {worker} duplicated as {twin} on {idle}")
+
+
+    def straggler_age(self, worker_id, batch):
+        '''
+        param:  worker_id string: worker holding the batch
+        param:  batch dict:       outstanding batch
+        return: secs after which the batch counts as straggling
+        A batch straggles once it took several times longer than the worker's
+        rate at its depth predicts, and at least STRAGGLER_AGE
+        '''
+        rate = self.workers[worker_id]['rate'].get(batch['tasks'][0][3])
+        if rate is None:
+            return self.STRAGGLER_AGE
+        return max(self.STRAGGLER_AGE, self.STRAGGLER_FACTOR * sum(task[4] for task in batch['tasks']) / rate)
+
+
+    def client_req(self, client_id, message):
+        '''
+        param:  client_id string: client id that sent the request
+        param:  message dict:     request with the board and depth to search
+        return: None
+        Answers a request from the cache, attaches it to an identical search
+        already in flight, or splits it into root move tasks. Requests with
+        different ids are served concurrently, a request reusing an id that is
+        still pending (or without an id) supersedes the previous one
+        '''
+        codec      = message.get("codec", GREGProtocol.JSON)
+        request_id = message.get("id")
+        self.add_client(client_id, codec)
+        self.detach_request(client_id, request_id)
+
+        b     = message["board"]
+        depth = message["depth"]
+        movetime = message.get("movetime")
+
+        board = chess.Board(fen=b)
+        key   = ResultCache.key(board, depth)
+
+        # timed searches stop at an unknown depth, they are never cached
+        if movetime:
+            key += (movetime,)
+            cached = None
+        else:
+            cached = self.cache.get(key)
+
+        # answer repeated positions from the cache
+        if cached is not None:
+            self.metrics.incr('requests_cached')
+            self.printg(f"cache hit {cached}")
+            self.send_reply(client_id, request_id, cached[0], cached[1])
+            # speculation on the position after the answer is still good
+            self.preempt(self.ponder(board, depth, cached[0]))
+            return
+
+        # same search already running, wait for its result
+        job_id = self.inflight.get(key)
+        if job_id is not None:
+            self.metrics.incr('requests_coalesced')
+            self.printg(f"coalesced into job {job_id}")
+            if self.jobs[job_id]['ponder']:
+                self.promote(job_id, client_id)
+            self.subscribe(client_id, request_id, job_id)
+            return
+
+        # real work comes first, speculation is abandoned
+        self.preempt()
+
+        job_id = self.start_job(key, board, depth, client_id, movetime)
+        self.subscribe(client_id, request_id, job_id)
+
+
+    def start_job(self, key, board, depth, owner, movetime=None, ponder=0):
+        '''
+        param:  key tuple:      result cache key of the position
+        param:  board Board:    position to search
+        param:  depth int:      depth of the search
+        param:  owner string:   client whose request created the job
+        param:  movetime int:   msecs the client gives the search, None for no limit
+        param:  ponder int:     plies the job speculates past a request, 0 for a request
+        return: job id
+        Creates a job and splits its position into root move tasks
+        '''
+        job_id = self.add_job(key, board, board.legal_moves.count(), owner, movetime, ponder)
+        self.queue_moves(job_id, board, [move.uci() for move in board.legal_moves], depth)
+        return job_id
+
+
+    def queue_moves(self, job_id, board, moves, depth):
+        '''
+        param:  job_id string:  job the moves belong to
+        param:  board Board:    position the moves are played in
+        param:  moves list:     root moves to search
+        param:  depth int:      depth of the search
+        return: None
+        Adds a task per root move, most expensive first so the job's longest
+        searches start first and its makespan is short
+        '''
+        costs = [(move_cost(board, move), move) for move in moves]
+        for cost, move in sorted(costs, reverse=True):
+            self.add_task((job_id, board, move, depth, cost))
+
+
+    def ponder(self, board, depth, move, plies=0):
+        '''
+        param:  board Board:    position a search answered
+        param:  depth int:      depth of the search
+        param:  move string:    best move of the search
+        param:  plies int:      plies the search speculated past a request
+        return: job id searching the position after the move, None if there is none
+        Speculatively searches the position after the best move, which is
+        the next position requested when a client plays it and, one ply
+        further, the position after the reply predicted by that search
+        '''
+        if plies >= self.ponder_plies or not move:
+            return None
+
+        board = board.copy(stack=False)
+        board.push(chess.Move.from_uci(move))
+        key   = ResultCache.key(board, depth)
+        if board.is_game_over() or key in self.cache.entries:
+            return None
+
+        # already searched further ahead, it is now nearer the requests
+        job_id = self.inflight.get(key)
+        if job_id is not None:
+            job = self.jobs[job_id]
+            job['ponder'] = min(job['ponder'], plies + 1)
+            return job_id
+
+        job_id = self.start_job(key, board, depth, self.PONDER, ponder=plies + 1)
+        self.pondering.add(job_id)
+        self.metrics.incr('ponder_jobs')
+        self.printg(f"pondering {board.fen()} in job {job_id}")
+        return job_id
+
+
+    def promote(self, job_id, client_id):
+        '''
+        param:  job_id string:    speculative job a client asked for
+        param:  client_id string: client that asked
+        return: None
+        Turns a speculative job into a request of the client, its queued tasks
+        move to the client's queue and batches already sent keep going
+        '''
+        job = self.jobs[job_id]
+        job['ponder']  = 0
+        job['owner']   = client_id
+        job['created'] = time.time()
+        self.pondering.discard(job_id)
+        for task in self.ponder_queue.drop(job_id):
+            self.add_task(task)
+        self.metrics.incr('ponder_promoted')
+
+
+    def preempt(self, keep=None):
+        '''
+        param:  keep string:    speculative job to keep searching, None for none
+        return: None
+        Drops every other speculative job, workers stop searching them
+        '''
+        for job_id in list(self.pondering):
+            if job_id == keep:
+                continue
+            self.end_job(job_id)
+            self.metrics.incr('ponder_preempted')
+
+
+    def returned_result(self, worker_id, job_id, batch_id, move, score):
         '''
         param:  worker_id string: worker id that has result
-        param:  client_id string: client id of job
+        param:  job_id string:    job id of the task
+        param:  batch_id int:     batch the result answers
         param:  move string:      result move
         param:  score int:        result score
         return: None
-        Takes incoming messages and sends results back to client if all moves recieved
-        Also trashes dead workers work and keeps track of clients best moves
+        Takes incoming messages and sends results back to clients if all moves recieved
+        Also keeps track of jobs best moves
+        MOVE and SCORE are the best of the worker's whole batch
         '''
-        # if dead, trash results, now alive again!
-        if not self.workers[worker_id]['alive']:
-            self.workers[worker_id]['alive'] = True
-            self.workers[worker_id]['task'] = ''
-        else:
-            self.clients[client_id]['received_moves'] += 1
-            self.workers[worker_id]['task'] = ''
+        info  = self.workers[worker_id]
+        batch = self.take_batch(worker_id, batch_id)
+
+        # stale result of a batch that was already requeued or cancelled
+        if batch is None:
+            return
+
+        # lost the race to its duplicate, the result was already counted
+        if batch['won'] is not None:
+            self.printg(f"batch {batch_id} lost to its duplicate")
+            if batch['twin'][1] > batch_id:
+                self.metrics.observe('straggler_saved', time.time() - batch['won'])
+            return
+        if batch['twin'] is not None:
+            self.twin_won(batch_id, batch)
+
+        # update worker's cost/sec at this depth, timed batches take their budget
+        tasks   = batch['tasks']
+        depth   = tasks[0][3]
+        if not batch['timed']:
+            elapsed = max(time.time() - batch['sent'], 1e-3)
+            sample  = sum(task[4] for task in tasks) / elapsed
+            rate    = info['rate'].get(depth)
+            info['rate'][depth] = sample if rate is None else (1 - self.RATE_WEIGHT)*rate + self.RATE_WEIGHT*sample
+
+        # if all its clients expired, nobody to answer
+        if job_id in self.jobs:
+            job = self.jobs[job_id]
+            job['received_moves'] += len(tasks)
             if score != float('-inf'):
                 score = int(score)
 
-                if score > self.clients[client_id]['best_score']: 
-                    self.clients[client_id]['best_move'] = move
-                    self.clients[client_id]['best_score'] = score
+                if score > job['best_score']: 
+                    job['best_move'] = move
+                    job['best_score'] = score
         
-            if self.clients[client_id]['received_moves'] == self.clients[client_id]['num_moves']:
-                msg = json.dumps({"move":self.clients[client_id]['best_move'], "score":self.clients[client_id]['best_score']}).encode()
-                
-                
-                self.printg(msg)
-                self.client.send_multipart([client_id, client_id, msg])
+            self.check_job(job_id)
+
+
+    def twin_won(self, batch_id, batch):
+        '''
+        param:  batch_id int:   batch whose result came back first
+        param:  batch dict:     the batch
+        return: None
+        The other copy of a duplicated batch lost, its result is dropped when
+        it comes back. It keeps its slot until then, its worker is busy
+        '''
+        worker_id, twin_id = batch['twin']
+        info = self.workers.get(worker_id)
+        twin = info['batches'].get(twin_id) if info is not None else None
+        if twin is None:
+            return
+
+        twin['won'] = time.time()
+        job = self.jobs.get(twin['tasks'][0][0])
+        if job is not None:
+            job['workers'].discard((worker_id, twin_id))
+            job['losers'].add((worker_id, twin_id))
+        self.metrics.incr('stragglers_won' if twin_id < batch_id else 'stragglers_lost')
+
+
+    def check_job(self, job_id):
+        '''
+        param:  job_id string: job that got a result
+        return: None
+        Finishes a job once all its root moves and split subtrees returned,
+        a mate was found and the other root moves cannot beat it, or the
+        deadline passed before anything came back
+        '''
+        job = self.jobs[job_id]
+        done = job['received_moves'] == job['num_moves'] and not job['children']
+        if done or job['best_score'] > self.MATE_SCORE or job['expired']:
+            self.finish_job(job_id)
+
+
+    def worker_split(self, job_id, message):
+        '''
+        param:  job_id string:  job whose root move the worker split
+        param:  message dict:   Split message with the subtrees left to search
+        return: None
+        Queues the subtrees of a root move as a child job, its best score is
+        merged into the root move's when it finishes. A root move split again
+        after it was requeued replaces its earlier child
+        '''
+        parent = self.jobs.get(job_id)
+        if parent is None:
+            return
+
+        board = chess.Board(fen=message["board"])
+        depth = message["depth"]
+        key   = ResultCache.key(board, depth) + (job_id, message["move"])
+
+        # the root move was requeued and split again, its first split is stale
+        stale = self.inflight.get(key)
+        if stale is not None:
+            parent['children'].discard(stale)
+            self.end_job(stale)
+
+        child = self.add_job(key, board, len(message["listOfMoves"]), parent['owner'], parent=(job_id, message["move"]))
+        parent['children'].add(child)
+        self.metrics.incr('splits')
+        self.queue_moves(child, board, message["listOfMoves"], depth)
+
+
+    def merge_child(self, job):
+        '''
+        param:  job dict:   finished child job
+        return: None
+        The best subtree of a split root move scores the move in its parent
+        '''
+        parent_id, move = job['parent']
+        parent = self.jobs.get(parent_id)
+        if parent is None:
+            return
+
+        parent['children'].discard(job['id'])
+        if job['best_score'] > parent['best_score']:
+            parent['best_move']  = move
+            parent['best_score'] = job['best_score']
+        self.check_job(parent_id)
+
+
+    def finish_job(self, job_id):
+        '''
+        param:  job_id string: job whose root moves all returned
+        return: None
+        Caches a job's result, sends it to every client waiting on it and
+        ponders the position it leads to
+        '''
+        job = self.end_job(job_id)
+        if job['parent'] is not None:
+            self.metrics.incr('splits_finished')
+            self.merge_child(job)
+            return
+        if job['ponder']:
+            self.metrics.incr('ponder_finished')
+        else:
+            self.metrics.incr('jobs_finished')
+            self.metrics.observe('job_latency', time.time() - job['created'])
+            self.metrics.observe('job_fanout', job['batches'])
+
+        if job['deadline'] is None:
+            self.cache.put(job['key'], job['best_move'], job['best_score'])
+            self.printg(self.cache.stats())
+
+        self.printg(f"job {job_id}: {job['best_move']} {job['best_score']}")
+        for client_id, request_id in job['clients']:
+            del self.clients[client_id]['requests'][request_id]
+            self.send_reply(client_id, request_id, job['best_move'], job['best_score'])
+
+        if job['deadline'] is None:
+            self.ponder(job['board'], job['key'][1], job['best_move'], job['ponder'])
+
 
-        self.workers[worker_id]['available'] = False
+    def send_reply(self, client_id, request_id, move, score):
+        '''
+        param:  client_id string: client to answer
+        param:  request_id int:   id of the answered request, None if it had none
+        param:  move string:      best move
+        param:  score int:        score of the best move
+        return: None
+        Sends a search result to a client in its codec
+        '''
+        result = {"move":move, "score":score}
+        if request_id is not None:
+            result["id"] = request_id
+
+        msg = GREGProtocol.encode(result, self.clients[client_id]['codec'])
+        self.client.send_multipart([client_id, client_id, msg])
+
+
+    def worker_progress(self, worker_id, progress, restarts=0, nps=0, cache=None):
+        '''
+        param:  worker_id string: worker that sent a heartbeat
+        param:  progress list:    [batch id, nodes, root moves left] of its batches
+        param:  restarts int:     engines the worker restarted since it started
+        param:  nps int:          nodes/sec the worker searches, 0 if it did not search yet
+        param:  cache list:       [lookups, hits] of the worker in the shared cache so far
+        return: None
+        Records how far along the worker's batches are and how fast the
+        worker is, and counts new engine restarts
+        '''
+        self.metrics.incr('worker_heartbeats')
+        info = self.workers[worker_id]
+        if nps and nps != info['nps']:
+            info['nps'] = nps
+            self.update_idle(worker_id)
+        if restarts > info['restarts']:
+            self.metrics.incr('engine_restarts', restarts - info['restarts'])
+            info['restarts'] = restarts
+        if cache:
+            info['cache'] = tuple(cache)
 
+        batches = info['batches']
+        now = time.time()
+        for batch_id, nodes, left in progress:
+            if batch_id in batches:
+                batches[batch_id]['progress'] = (now, nodes, left)
+                self.printg(f"batch {batch_id}: {nodes} nodes, {left} moves left")
 
-    def add_worker(self, worker_id, available=False, alive=True, task='', expiry=0):
+
+    def add_worker(self, worker_id, slots=1):
         '''
         param:  worker_id string: worker id recieved from message
-        param:  available bool:   if worker is available
-        param:  task string:      task to assign to worker
-        param:  expiry int:       time till declared dead
+        param:  slots int:        number of batches the worker holds at once
         return: None
-        adds worker structure
-            available: bool: if worker is available
-            expiry: float: expire time for worker to be considered dead
-            alive: bool: if worker is alive
-            task: string: task worker is working on
+        adds worker structure, expiry is tracked in worker_expiry
+            slots: int: number of batches the worker holds at once, queued ones included
+            engines: int: number of batches the worker searches at once
+            batches: dict: batch id -> tasks of the batch, time it was sent, last
+                (time, nodes, root moves left) the worker reported for it, the
+                (worker, batch id) of its duplicate and when the duplicate won
+            rate: dict: EWMA of root move cost/sec solved per batch, per depth
+            nps: int: nodes/sec the worker last reported
+            restarts: int: engine restarts the worker last reported
+            cache: tuple: (lookups, hits) the worker last reported of the shared cache
+            codec: string: wire codec of the worker
+            positions: OrderedDict: jobs whose position a binary worker holds
         '''
         self.workers[worker_id] = {
-            'available': available,
-            'alive': alive,
-            'task': task,
-            'expiry': expiry
+            'slots': slots,
+            'engines': slots,
+            'batches': dict(),
+            'rate': dict(),
+            'nps': 0,
+            'restarts': 0,
+            'cache': (0, 0),
+            'codec': GREGProtocol.JSON,
+            'positions': collections.OrderedDict()
         }
+        self.update_idle(worker_id)
 
 
-    def add_client(self, client_id, num_moves):
+    def add_client(self, client_id, codec=GREGProtocol.JSON):
         '''
         param:  client_id string: client id received from message
-        param:  num_moves int: number of moves/tasks to be recollected
+        param:  codec string:     wire codec of the client
         return: None
-        adds client structure 
-            alive: bool: client connected or not
-            expiry: float: expire time for a client to be considered dead
+        adds client structure if new, expiry is tracked in client_expiry
+            requests: dict: pending request id -> job answering it
+            codec: string: wire codec of the client
+        '''
+        if client_id in self.clients:
+            self.clients[client_id]['codec'] = codec
+            return
+
+        self.clients[client_id] = {
+            'requests': dict(),
+            'codec': codec
+        }
+
+
+    def subscribe(self, client_id, request_id, job_id):
+        '''
+        param:  client_id string: client waiting on the job
+        param:  request_id int:   id of the client's request
+        param:  job_id string:    job answering the request
+        return: None
+        Subscribes a client's request to a job's result
+        '''
+        self.clients[client_id]['requests'][request_id] = job_id
+        self.jobs[job_id]['clients'].append((client_id, request_id))
+
+
+    def add_job(self, key, board, num_moves, owner, movetime=None, ponder=0, parent=None):
+        '''
+        param:  key tuple:      result cache key of the searched position
+        param:  board Board:    searched position
+        param:  num_moves int:  number of moves/tasks to be recollected
+        param:  owner string:   client whose request created the job
+        param:  movetime int:   msecs the client gives the search, None for no limit
+        param:  ponder int:     plies the job speculates past a request, 0 for a request
+        param:  parent tuple:   (job, root move) whose subtrees a child job searches
+        return: job id
+        adds job structure and marks its search in flight
+            id: string: job id
+            key: tuple: result cache key of the searched position
+            board: Board: searched position
+            owner: string: client whose request created the job, its tasks are queued under it
+            ponder: int: plies the job speculates past a request, 0 unless speculative
+            parent: tuple: (job, root move) a child job scores, None for other jobs
+            children: set: child jobs searching split subtrees of the job's root moves
+            losers: set: (worker, batch id) pairs that lost to their duplicate, still searching
+            clients: list: (client, request id) pairs waiting on the result
+            created: float: time the job was created
+            deadline: float: time the client is answered at, None for no limit
+            expired: bool: deadline passed with no result, the first one answers
+            batches: int: number of batches sent to workers
+            workers: set: (worker, batch id) pairs holding a batch of the job
             best_move: string: the current best move returned by a worker based on score
-            num_moves: int: number of moves/tasks to be recollected at that time
+            best_score: int: score of best_move
+            num_moves: int: number of moves/tasks to be recollected
             received_moves: int: num of moves currently received
         '''
+        self.next_job += 1
+        job_id = str(self.next_job).encode()
 
-        self.clients[client_id] = {
-            'alive': True,
-            'expiry': 0,
+        created  = time.time()
+        deadline = created + movetime / 1000 if movetime else None
+        if deadline is not None:
+            heapq.heappush(self.deadlines, (deadline, job_id))
+
+        self.jobs[job_id] = {
+            'id': job_id,
+            'key': key,
+            'board': board,
+            'owner': owner,
+            'ponder': ponder,
+            'parent': parent,
+            'children': set(),
+            'losers': set(),
+            'clients': [],
+            'created': created,
+            'deadline': deadline,
+            'expired': False,
+            'batches': 0,
+            'workers': set(),
             'best_move': '',
             'best_score': float('-inf'),
             'num_moves': num_moves,
             'received_moves': 0
         }
+        self.inflight[key] = job_id
+        if not ponder and parent is None:
+            self.metrics.incr('jobs_created')
+        return job_id
+
+
+    def end_job(self, job_id):
+        '''
+        param:  job_id string: job to remove
+        return: the removed job structure
+        Removes a job and its queued tasks, and tells workers still searching
+        its root moves to stop
+        '''
+        job = self.jobs.pop(job_id)
+        del self.inflight[job['key']]
+
+        # split subtrees nobody waits for anymore
+        for child in job['children']:
+            if child in self.jobs:
+                self.end_job(child)
+
+        self.work_queue.drop(job_id)
+        self.ponder_queue.drop(job_id)
+        self.pondering.discard(job_id)
+
+        # one cancel per worker stops every batch of the job it holds
+        cancelled = set()
+        for worker_id, batch_id in job['workers']:
+            del self.workers[worker_id]['batches'][batch_id]
+            self.update_idle(worker_id)
+            cancelled.add(worker_id)
+
+        # losing copies of duplicated batches are left to finish, unless
+        # their worker is told to drop the job
+        for worker_id, batch_id in job['losers']:
+            if worker_id in cancelled:
+                self.workers[worker_id]['batches'].pop(batch_id, None)
+                self.update_idle(worker_id)
+
+        for worker_id in cancelled:
+            self.printg(f"cancel job {job_id} on {worker_id}")
+            self.metrics.incr('cancels_sent')
+            msg = GREGProtocol.encode({"type":"Cancel"}, self.workers[worker_id]['codec'])
+            self.worker.send_multipart([worker_id, job_id, msg])
+        return job
+
+
+    def detach_request(self, client_id, request_id):
+        '''
+        param:  client_id string: client that no longer waits on a request
+        param:  request_id int:   id of the abandoned request
+        return: None
+        Detaches a request from its job, the job is dropped once nobody waits on it
+        '''
+        job_id = self.clients[client_id]['requests'].pop(request_id, None)
+        if job_id is None:
+            return
+
+        job = self.jobs[job_id]
+        job['clients'].remove((client_id, request_id))
+        if not job['clients']:
+            self.printg(f"drop job {job_id}")
+            self.metrics.incr('jobs_dropped')
+            self.end_job(job_id)
 
     def worker_die(self, worker_id):
         '''
         param:  worker_id string: worker to be marked as dead
         return: None
-        Declares workers dead
+        Declares workers dead and reclaims their record
         '''
-        # check if there was work assigned
-        task = self.workers[worker_id]['task']
-
         # redistribute work
-        if task != '':
-            self.work_queue.append(task)
-            self.workers[worker_id]['task'] = ''
+        self.metrics.incr('workers_died')
+        self.metrics.incr('tasks_requeued_dead', self.requeue(worker_id))
+
+        # forget worker, it is reset if it ever talks again
+        self.worker_expiry.forget(worker_id)
+        del self.workers[worker_id]
+        self.update_idle(worker_id)
+
 
-        # mark worker as dead and not available
-        self.workers[worker_id]['available'] = False
-        self.workers[worker_id]['alive'] = False
+    def client_die(self, client_id):
+        '''
+        param:  client_id string: client to be marked as dead
+        return: None
+        Declares clients dead, drops their unshared work and reclaims their record
+        '''
+        self.metrics.incr('clients_died')
+        for request_id in list(self.clients[client_id]['requests']):
+            self.detach_request(client_id, request_id)
+        self.client_expiry.forget(client_id)
+        del self.clients[client_id]
 
 
     def update_nameserver(self, signum, frame):
@@ -206,20 +1472,11 @@ class ChessServer:
         param:  signum Signal
         param:  frame Stackframe
         return: None
-        Updates Nameserver with server name
+        Registers the server's ports with the discovery backend
         '''
-        addrs = socket.getaddrinfo(NSERVER, NPORT, socket.AF_UNSPEC, socket.SOCK_DGRAM)
-        for addr in addrs:
-            ai_fam, stype, proto, name, sa = addr
-            try:
-                s = socket.socket(ai_fam, stype, proto)
-            except:
-                continue
-
-            s.sendto(json.dumps({"type":f"{self.name}chessClient","owner":"MMBW","port":self.c_port,"project":"GREGChessApp"}).encode(), sa)
-            s.sendto(json.dumps({"type":f"{self.name}chessWorker","owner":"MMBW","port":self.w_port,"project":"GREGChessApp"}).encode(), sa)
-            s.close()
-            break
+        self.discovery.register(f"{self.name}chessClient", self.c_port)
+        self.discovery.register(f"{self.name}chessWorker", self.w_port)
+        self.discovery.register(f"{self.name}chessMetrics", self.m_port)
 
     
     def update_expiry(self, is_worker, ident):
@@ -229,13 +1486,195 @@ class ChessServer:
         return: None
         Updates expiry upon heartbeat
         '''
+        expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
         if is_worker:
-            self.workers[ident]['expiry'] = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
-            if ident in self.waiting:
-                self.waiting.remove(ident)
-            self.waiting.append(ident)
+            self.worker_expiry.touch(ident, expiry)
         else:
-            self.clients[ident]['expiry'] = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
+            self.client_expiry.touch(ident, expiry)
+
+
+    def publish_metrics(self):
+        '''
+        param:  None
+        return: None
+        Publishes a metrics snapshot on the metrics socket
+        '''
+        gauges = {
+            'queued_tasks': len(self.work_queue),
+            'ponder_tasks': len(self.ponder_queue),
+            'workers': len(self.workers),
+            'workers_idle': len(self.idle),
+            'workers_busy': len(self.workers) - len(self.idle),
+            'slots': sum(info['slots'] for info in self.workers.values()),
+            'slots_busy': sum(len(info['batches']) for info in self.workers.values()),
+            'clients': len(self.clients),
+            'jobs': len(self.jobs),
+            'cache': self.cache.stats(),
+            'shared_cache': dict()
+        }
+
+        # hit rate of every worker using a shared cache
+        for worker_id, info in self.workers.items():
+            probes, hits = info['cache']
+            if probes:
+                gauges['shared_cache'][worker_id.hex()] = {'lookups': probes, 'hits': hits, 'hit_rate': hits / probes}
+
+        snapshot = self.metrics.snapshot(gauges)
+        self.metrics_socket.send(json.dumps(snapshot).encode())
+        self.metrics_at = time.time() + self.METRICS_INTERVAL
+
+
+    def watch_peers(self, discovery):
+        '''
+        param:  discovery Discovery:    backend of this thread, the main loop keeps its own
+        return: None
+        Runs on its own thread: looks up the servers registered for the
+        service every PEER_INTERVAL secs, so a slow discovery backend never
+        holds up the main loop. A server alone under its name has no peers.
+        A failed lookup keeps the peers found last time
+        '''
+        while True:
+            try:
+                entries = dict()
+                for item in discovery.lookup(f"{self.name}chessMetrics"):
+                    host, port = item.get("name"), item.get("port")
+                    if host is None or port is None:
+                        continue
+                    entries[f"{host}:{port}"] = host
+                self.peer_entries = entries if len(entries) > 1 else dict()
+            except Exception as e:
+                self.printg(f"peer lookup failed: {e}", True)
+            time.sleep(self.PEER_INTERVAL)
+
+
+    def find_peers(self):
+        '''
+        param:  None
+        return: None
+        Subscribes to the load reports of the servers watch_peers found and
+        drops the ones that stopped registering
+        '''
+        entries = self.peer_entries
+        for endpoint in list(self.peers):
+            if endpoint not in entries:
+                self.peers.pop(endpoint)['socket'].close()
+
+        for endpoint, host in entries.items():
+            if endpoint not in self.peers:
+                sub = self.context.socket(zmq.SUB)
+                sub.setsockopt(zmq.LINGER, 0)
+                sub.setsockopt(zmq.SUBSCRIBE, self.LOAD)
+                sub.connect(f"tcp://{endpoint}")
+                self.peers[endpoint] = {'socket': sub, 'host': host, 'load': None, 'heard': 0}
+
+        # keep the newest report of every peer, ours are ignored
+        for peer in self.peers.values():
+            while peer['socket'].poll(0):
+                load = json.loads(peer['socket'].recv()[len(self.LOAD):])
+                if load['broker'] != self.broker_id:
+                    peer['load']  = load
+                    peer['heard'] = time.time()
+
+
+    def publish_load(self):
+        '''
+        param:  None
+        return: None
+        Reports how much work is queued and how many workers are idle to the
+        other servers of the service
+        '''
+        load = {
+            'broker': self.broker_id,
+            'worker_port': self.w_port,
+            'queued_tasks': len(self.work_queue),
+            'workers': len(self.workers),
+            'workers_idle': len(self.idle)
+        }
+        self.metrics_socket.send(self.LOAD + json.dumps(load).encode())
+        self.load_at = time.time() + self.LEND_INTERVAL
+
+
+    def lend_workers(self):
+        '''
+        param:  None
+        return: None
+        When nothing is queued here, workers with no batches are moved to the
+        servers of the service whose workers are all busy and that have the
+        most tasks queued, enough of them to take a batch each
+        '''
+        self.lend_at = time.time() + self.LEND_INTERVAL
+        self.find_peers()
+        if not self.peers or len(self.work_queue) > 0:
+            return
+
+        free = [worker_id for worker_id in self.idle if not self.workers[worker_id]['batches']]
+        free = free[:max(0, len(self.workers) - self.LEND_KEEP)]
+
+        # peers that did not report lately may be gone
+        recent = time.time() - 3 * self.LEND_INTERVAL
+        needy  = [peer['load'] | {'host': peer['host']} for peer in self.peers.values() if peer['heard'] > recent and peer['load']['queued_tasks'] > 0 and peer['load']['workers_idle'] == 0]
+        needy.sort(key=lambda load: load['queued_tasks'] / max(1, load['workers']), reverse=True)
+
+        for load in needy:
+            while free and load['queued_tasks'] > 0:
+                self.lend_worker(free.pop(0), load['host'], load['worker_port'])
+
+                # until its next report, the peer counts as a batch of work less busy
+                load['queued_tasks'] -= self.BATCH_MAX
+
+
+    def lend_worker(self, worker_id, host, port):
+        '''
+        param:  worker_id string: idle worker with no batches
+        param:  host string:      host of the server it is lent to
+        param:  port int:         worker port of that server
+        return: None
+        Tells the worker to move and forgets it, like a worker that died
+        with nothing to requeue
+        '''
+        self.metrics.incr('workers_lent')
+        msg = GREGProtocol.encode({"type":"Move", "host":host, "port":port}, self.workers[worker_id]['codec'])
+        self.worker.send_multipart([bytes(worker_id), b"", msg])
+        self.worker_expiry.forget(worker_id)
+        del self.workers[worker_id]
+        self.update_idle(worker_id)
+        self.printg(f"lent worker {worker_id} to {host}:{port}")
+
+
+    def expire_jobs(self):
+        '''
+        param:  None
+        return: None
+        Answers timed jobs whose deadline passed with the best result so far
+        '''
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, job_id = heapq.heappop(self.deadlines)
+            job = self.jobs.get(job_id)
+
+            # finished early or dropped
+            if job is None or job['deadline'] != deadline:
+                continue
+
+            self.metrics.incr('jobs_deadline')
+            if job['received_moves'] > 0:
+                self.finish_job(job_id)
+            else:
+                job['expired'] = True
+
+
+    def poll_timeout(self):
+        '''
+        param:  None
+        return: msecs to poll for, until the next deadline, look for
+                stragglers or report the load at the latest
+        '''
+        timeout = min(self.POLL_TIMEOUT, int(self.LEND_INTERVAL * 1000))
+        if self.idle and self.jobs:
+            timeout = int(self.STRAGGLER_INTERVAL * 1000)
+        if not self.deadlines:
+            return timeout
+        return max(0, min(timeout, int((self.deadlines[0][0] - time.time()) * 1000) + 1))
 
 
     def purge_workers(self):
@@ -244,15 +1683,9 @@ class ChessServer:
         return: None
         Purges dead workers
         '''
-        while self.waiting:
-            worker = self.waiting[0]
-            # workers in order of expiry
-            if self.workers[worker]['expiry'] < time.time():
-                self.printg(f"delete expired worker {worker}")
-                self.worker_die(worker)
-                self.waiting.pop(0)
-            else:
-                break
+        for worker in self.worker_expiry.expired(time.time()):
+            self.printg(f"delete expired worker {worker}")
+            self.worker_die(worker)
 
 
     def purge_clients(self):
@@ -261,10 +1694,9 @@ class ChessServer:
         return: None
         Purges dead clients
         '''
-        for client, info in self.clients.items():
-            if info['alive'] and info['expiry'] < time.time():
-                self.printg(f"delete expired client {client}")
-                self.clients[client]['alive'] = False
+        for client in self.client_expiry.expired(time.time()):
+            self.printg(f"delete expired client {client}")
+            self.client_die(client)
 
     
     def run(self):
@@ -281,29 +1713,40 @@ class ChessServer:
         # main loop
         while True:
             # get lists of readable sockets
-            self.printg(self.work_queue)
-            socks = dict(poller.poll())
+            self.printg(f"queued tasks: {len(self.work_queue)}")
+            socks = dict(poller.poll(self.poll_timeout()))
  
             # if WORKER has a message!
             if self.worker in socks and socks[self.worker] == zmq.POLLIN:
-                w_id, c_id, message = self.worker.recv_multipart()
-                message = json.loads(message)
+                w_id, job_id, data = self.worker.recv_multipart()
+                self.metrics.incr('worker_messages')
+                message = GREGProtocol.decode(data)
                 self.printg(message)
                 msg_type = message["type"]
 
                 # worker ready
-                if msg_type == "WorkerRequest":
-                    self.worker_req(w_id)
+                if msg_type == "WorkerRequest" and message.get("status") != "Resync":
+                    codec = GREGProtocol.BINARY if GREGProtocol.is_binary(data) else message.get("codec", GREGProtocol.JSON)
+                    self.worker_req(w_id, codec, message.get("slots", 1), message.get("engines"))
                     self.printg("ya worker ready")
+
+                # declared dead, its tasks were requeued
+                elif w_id not in self.workers:
+                    self.reset_worker(w_id, GREGProtocol.BINARY if GREGProtocol.is_binary(data) else GREGProtocol.JSON)
+
+                elif msg_type == "WorkerRequest":
+                    self.worker_resync(w_id, message["batch"])
+                elif msg_type == "Split":
+                    self.worker_split(job_id, message)
                 elif msg_type == "<3":
                     self.printg("<3")
-                    pass
+                    self.worker_progress(w_id, message.get("progress", []), message.get("restarts", 0), message.get("nps", 0), message.get("cache"))
 
                 # worker returned result    
                 else:
                     move  = message["move"]
                     score = message["score"]
-                    self.returned_result(w_id, c_id, move, score)
+                    self.returned_result(w_id, job_id, message["batch"], move, score)
 
                 # update expiry time
                 if w_id in self.workers:
@@ -312,58 +1755,51 @@ class ChessServer:
             # if CLIENT has a message!
             if self.client in socks and socks[self.client] == zmq.POLLIN:
                 # read and parse message
-                c_id, message = self.client.recv_multipart()
-                message       = json.loads(message.decode())
+                c_id, data = self.client.recv_multipart()
+                self.metrics.incr('client_messages')
+                message    = GREGProtocol.decode(data)
+                if GREGProtocol.is_binary(data):
+                    message["codec"] = GREGProtocol.BINARY
                 
                 if message.get("type") == "<3":
                     self.printg("client <3")
                     pass
                 else:
                     self.printg(f"{c_id} {message}")
-
-                    b     = message["board"]
-                    depth = message["depth"]
-
-                    board = chess.Board(fen=b)
-                    
-                    legal_moves = board.legal_moves
-                    num_moves = legal_moves.count()
-
-                    # split up possible moves and add to task queue
-                    for move in board.pseudo_legal_moves:
-                        if move in board.legal_moves:
-                            self.add_task((c_id, board, move.uci(), depth))
-                
-                    self.add_client(c_id, num_moves=num_moves)
+                    self.client_req(c_id, message)
                 
                 if c_id in self.clients:
                     self.update_expiry(is_worker=False, ident=c_id)
             
-            # send tasks to workers
-            available_workers = [x for x in self.workers if self.workers[x]['available'] and self.workers[x]['alive']]
-            
+            # answer timed jobs at their deadline
+            self.expire_jobs()
+
+            # send tasks to idle workers
             self.printg("checking to send work")
-            while len(self.work_queue) > 0 and len(available_workers) > 0:
-                client_id, board, move, depth = self.work_queue.pop() 
-                if self.clients[client_id]['alive']:       
-                    worker = available_workers.pop()
-                    msg = json.dumps({"listOfMoves":[move], "board":board.fen(),"depth":depth}).encode()
-                    self.printg(msg)
-                    self.workers[worker]['task'] = (client_id, board, move, depth)
-                    self.worker.send_multipart([bytes(worker), bytes(client_id), msg])
-                    
-                    # worker no longer available until 'ready' again
-                    self.workers[worker]['available'] = False
+            self.dispatch()
           
+            # idle workers help other servers of the service
+            if len(self.idle) > 0 and time.time() >= self.lend_at:
+                self.lend_workers()
+
             self.purge_workers()
             self.purge_clients()
 
+            if time.time() > self.metrics_at:
+                self.publish_metrics()
+            if time.time() >= self.load_at:
+                self.publish_load()
+
 
 # Main Execution
 def main():
     # options
     debug  = False
     name   = ""
+    cache  = 16
+    port   = 0
+    ponder = 2
+    discovery = GREGDiscovery.DEFAULT
     argind = 1
     
     # parse args
@@ -375,6 +1811,18 @@ def main():
         elif arg == "-n":
             argind += 1
             name = sys.argv[argind]
+        elif arg == "-c":
+            argind += 1
+            cache = int(sys.argv[argind])
+        elif arg == "-m":
+            argind += 1
+            port = int(sys.argv[argind])
+        elif arg == "-p":
+            argind += 1
+            ponder = int(sys.argv[argind])
+        elif arg == "-D":
+            argind += 1
+            discovery = sys.argv[argind]
         elif arg == "-h":
             usage(0)
         else:
@@ -382,7 +1830,7 @@ def main():
         argind += 1
 
     # run game
-    server = ChessServer(debug, name)
+    server = ChessServer(debug, name, cache, port, discovery, ponder)
     server.run()
 
 if __name__ == "__main__":
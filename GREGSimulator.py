@@ -28,6 +28,7 @@ def usage(status):
     print(f"    -g GAMES    Number of Games to play")
     print(f"    -c COUNT    Number of workers (Only for use with WorkerManager)")
     print(f"    -s H P      Server Host and Port (Only for use with WorkerManager)")
+    print(f"    -D SPEC     Discovery backend passed to clients")
     print(f"    -d          Debug")
     print(f"    -h          help")
     exit(status)
@@ -89,7 +90,7 @@ def make_move(proc, move, turn, debug):
     proc.stdin.flush()
     return
 
-def play_game(black_depth=1, white_depth=1, name="", debug=False):
+def play_game(black_depth=1, white_depth=1, name="", debug=False, discovery=[]):
     ''' 
     plays a game of CPU vs CPU
     1. "black" gets the whites cpu move
@@ -101,8 +102,8 @@ def play_game(black_depth=1, white_depth=1, name="", debug=False):
     '''
     
     # start players
-    black = subprocess.Popen(["python", "./GREGClient.py", "-d", white_depth, "-n", name, "-b", "-s"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    white = subprocess.Popen(["python", "./GREGClient.py", "-d", black_depth, "-n", name, "-s"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    black = subprocess.Popen(["python", "./GREGClient.py", "-d", white_depth, "-n", name, "-b", "-s"] + discovery, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    white = subprocess.Popen(["python", "./GREGClient.py", "-d", black_depth, "-n", name, "-s"] + discovery, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 
     # play game
     while not GameOver:
@@ -143,6 +144,7 @@ def main():
     argind      = 1
     host        = "student10.cse.nd.edu"
     port        = 7777
+    discovery   = []
     
     # parse command args
     while argind < len(sys.argv):
@@ -169,6 +171,9 @@ def main():
         elif arg == "-w":
             argind += 1
             white_depth = sys.argv[argind]
+        elif arg == "-D":
+            argind += 1
+            discovery = ["-D", sys.argv[argind]]
         elif arg == "-h":
             usage(0)
         else:
@@ -194,7 +199,7 @@ def main():
         NumMoves = 0
 
         # play the game
-        play_game(black_depth, white_depth, name, debug)
+        play_game(black_depth, white_depth, name, debug, discovery)
         
         # end
         total_time = time.time_ns() - start
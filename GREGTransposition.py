@@ -0,0 +1,161 @@
+# GREG Transposition Table
+import array
+import chess
+import chess.polyglot
+import GREGProtocol
+
+# Globals
+RANDOM   = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+PIECES   = [(color, piece_type) for color in chess.COLORS for piece_type in chess.PIECE_TYPES]
+CASTLING = [(chess.BB_H1, RANDOM[768]), (chess.BB_A1, RANDOM[769]), (chess.BB_H8, RANDOM[770]), (chess.BB_A8, RANDOM[771])]
+HASHER   = chess.polyglot.ZobristHasher(RANDOM)
+
+# bound of a stored score
+EXACT = 0
+LOWER = 1   # score failed high, true score is at least this
+UPPER = 2   # score failed low, true score is at most this
+
+# Functions
+def byte_tables(color, piece_type):
+    '''
+    param:  color bool:       piece color
+    param:  piece_type int:   piece type
+    return: 8 tables, one per byte of the piece's bitboard, of the xor of the
+            square keys of every byte value
+    '''
+    base   = 64 * ((piece_type - 1) * 2 + int(color))
+    tables = []
+    for k in range(8):
+        table = [0] * 256
+        for value in range(1, 256):
+            low = value & -value
+            table[value] = table[value ^ low] ^ RANDOM[base + 8*k + low.bit_length() - 1]
+        tables.append(table)
+    return tables
+
+
+BYTE_TABLES = [(piece_type, color, byte_tables(color, piece_type)) for color, piece_type in PIECES]
+
+
+def zobrist(board):
+    '''
+    param:  board Board: standard chess position
+    return: int 64 bit polyglot Zobrist key, same as chess.polyglot.zobrist_hash
+    Hashes the pieces a bitboard byte at a time instead of a square at a time
+    '''
+    key = RANDOM[780] if board.turn == chess.WHITE else 0
+    for piece_type, color, tables in BYTE_TABLES:
+        mask = board.pieces_mask(piece_type, color)
+        k = 0
+        while mask:
+            key ^= tables[k][mask & 0xff]
+            mask >>= 8
+            k += 1
+
+    rights = board.clean_castling_rights()
+    if rights:
+        for rook, random in CASTLING:
+            if rights & rook:
+                key ^= random
+
+    if board.ep_square is not None:
+        key ^= HASHER.hash_ep_square(board)
+    return key
+
+
+# Classes
+class TranspositionTable:
+    '''
+    Fixed size table of search results keyed by Zobrist key, shared by the
+    search threads of a worker. An entry is two 64 bit words in flat arrays:
+    the data word (best move, score, depth, bound, generation) and the key xored
+    with the data word, so an entry torn by two threads storing at once reads
+    as a miss. Deeper entries are kept unless they are from an older search.
+    '''
+    ENTRY_BYTES = 16
+    SCORE_BIAS  = 2**31
+    MAX_DEPTH   = 63
+
+    def __init__(self, max_bytes):
+        size = 1
+        while size * 2 * self.ENTRY_BYTES <= max_bytes:
+            size *= 2
+        self.mask   = size - 1
+        self.checks = array.array("Q", bytes(8 * size))
+        self.data   = array.array("Q", bytes(8 * size))
+        self.generation = 1
+        self.probes   = 0
+        self.hits     = 0
+        self.stores   = 0
+        self.replaced = 0
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def new_search(self):
+        '''
+        param:  None
+        return: None
+        Ages the entries stored so far, new entries replace them first
+        '''
+        self.generation = self.generation % 255 + 1
+
+
+    def probe(self, key):
+        '''
+        param:  key int:    Zobrist key of the position
+        return: (depth, score, best move, bound) of the position, or None
+        '''
+        self.probes += 1
+        index = key & self.mask
+        data  = self.data[index]
+        if self.checks[index] ^ data != key:
+            return None
+
+        self.hits += 1
+        score = ((data >> 16) & 0xffffffff) - self.SCORE_BIAS
+        return (data >> 48) & 0x3f, score, GREGProtocol.unpack_move(data & 0xffff), (data >> 54) & 0x3
+
+
+    def store(self, key, depth, score, move=None, bound=EXACT):
+        '''
+        param:  key int:      Zobrist key of the position
+        param:  depth int:    depth the position was searched to
+        param:  score int:    score from the side to move
+        param:  move string:  best move of the side to move, None if unknown
+        param:  bound int:    EXACT, or LOWER/UPPER if the search failed high/low
+        return: None
+        '''
+        depth = min(depth, self.MAX_DEPTH)
+        index = key & self.mask
+        old   = self.data[index]
+        if old:
+            same = self.checks[index] ^ old == key
+            # keep a deeper entry of this search
+            if old >> 56 == self.generation and (old >> 48) & 0x3f > depth:
+                return
+            if not same:
+                self.replaced += 1
+
+        score = max(-self.SCORE_BIAS, min(self.SCORE_BIAS - 1, int(score)))
+        data  = GREGProtocol.pack_move(move) | (score + self.SCORE_BIAS) << 16 | depth << 48 | bound << 54 | self.generation << 56
+        self.data[index]   = data
+        self.checks[index] = key ^ data
+        self.stores += 1
+
+
+    def stats(self):
+        '''
+        param:  None
+        return: dict of table statistics
+        '''
+        return {
+            'entries': len(self.data),
+            'probes': self.probes,
+            'hits': self.hits,
+            'stores': self.stores,
+            'replaced': self.replaced,
+            'hit_rate': self.hits / self.probes if self.probes else 0.0
+        }
@@ -4,15 +4,23 @@ import zmq.utils.monitor
 import chess
 import chess.engine
 import sys
-import http.client
-import json
 import concurrent.futures
 import time
-import zmq.utils.monitor
-import signal
+import os
+import queue
+import threading
+import collections
+import socket
+import hashlib
+import GREGProtocol
+import GREGDiscovery
+import GREGEvaluator
+import GREGTransposition
+import GREGCache
 
 # Globals
-NSERVER = "catalog.cse.nd.edu:9097"
+ENGINE     = "./bin/stockfish"
+WARM_DEPTH = 8      # depth of the search an engine runs before it is used
 
 # Functions
 def usage(status):
@@ -25,30 +33,123 @@ def usage(status):
     print(f"    -n NAME    Add unique name")
     print(f"    -d         Turn on Debugging")
     print(f"    -p         Turn on pretty printing")
+    print(f"    -j         JSON only wire protocol")
+    print(f"    -e N       Engine processes searching in parallel, 0 for one per core (default=1)")
+    print(f"    -E EVAL    Leaf evaluator, stockfish or static (default={GREGEvaluator.DEFAULT})")
+    print(f"    -t MB      Transposition table size in MB (default=16, 0 to disable)")
+    print(f"    -S SEARCH  Search of every root move, solve or pvs (default=solve)")
+    print(f"    -M WIDTH   Moves ranked by solve's MultiPV pre-screen, 0 to score every move (default=5)")
+    print(f"    -L DEPTH   Depth of the MultiPV pre-screen (default=1)")
+    print(f"    -P N       Batches queued at the worker on top of one per engine (default=1)")
+    print(f"    -o OPT=VAL Stockfish UCI option, e.g. -o Hash=64 -o Threads=2 (repeatable)")
+    print(f"    -C ADDR    Shared transposition cache at HOST:PORT, or find to look it up (needs -t)")
+    print(f"    -D SPEC    Discovery backend (default={GREGDiscovery.DEFAULT})")
     exit(status)
 
 
+def open_engine(options=None):
+    '''
+    param:  options dict:   UCI options of the engine
+    return: SimpleEngine configured and warmed up
+    Starts Stockfish and runs a throwaway search, so the hash is allocated
+    and the first real search does not pay for it
+    '''
+    engine = chess.engine.SimpleEngine.popen_uci(ENGINE)
+    try:
+        engine.configure(options or {})
+        engine.analyse(chess.Board(), chess.engine.Limit(depth=WARM_DEPTH))
+    except:
+        engine.close()
+        raise
+    return engine
+
+
+def engine_option(value):
+    '''
+    param:  value string:   option value from the command line
+    return: value as python-chess expects it, check options take bools
+    '''
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return value
+
+
 # Classes 
+class JobCancelled(Exception):
+    '''
+    Raised inside a search when the server cancels the job being solved
+    '''
+    pass
+
+
 class ChessWorker:
     HEARTBEAT_INTERVAL = 5000
-    HEARTBEAT_INTERVAL_S = 5
+    CONNECT_TIMEOUT = 2000  # msecs to wait for a handshake
+    RETRY_DELAY = 1         # secs between discovery attempts
+    POSITIONS = 64  # job positions kept, at least the server's POSITIONS
+    SEARCHES = ["solve", "pvs"]
+    INFINITY = 10**9
+    MATE_BOUND = GREGEvaluator.MATE_SCORE - 1000  # scores past this are mates, stored relative to the node
+    MOVETIME_MARGIN = 0.05  # secs of a timed batch kept for sending its result
+    ENGINE_RETRIES = 2      # restarts of a dead engine per root move before giving up on it
+    TOP_MOVES = 5           # moves solve searches after its pre-screen
+    SPLIT_DEPTH = 3         # depth from which a root move's subtree is shared with other workers
+    CACHE_DEPTH = {"solve": 3, "pvs": 3}  # depth of each search from which a position is worth a shared cache round trip
 
     #########################
     #    Class Functions    #
     #########################
-    def __init__(self, pretty=False, debug=False, name=''):
-        global Engine
-        self.engine = Engine
+    def __init__(self, engines, pretty=False, debug=False, name='', codec=GREGProtocol.BINARY, discovery=GREGDiscovery.DEFAULT, evaluator=GREGEvaluator.DEFAULT, table_mb=16, search="solve", multipv=5, multipv_depth=1, prefetch=1, engine_options=None, cache=None):
+        self.engines = engines
+        self.engine_options = engine_options
+        self.restarts = 0
+        self.searched = 0       # nodes and thread secs of searches since the last heartbeat
+        self.search_time = 0.0
+        self.nps = 0
+        self.stats_lock = threading.Lock()
+        self.prefetch = prefetch
+        self.evaluator = evaluator
+        self.search = search
+        self.multipv = multipv
+        self.multipv_depth = multipv_depth
+        self.table = GREGTransposition.TranspositionTable(table_mb * 1024 * 1024) if table_mb else None
+        self.cache = cache if self.table is not None else None
+        self.cache_clients = []
         self.pretty = pretty
         self.debug  = debug
         self.name   = name
+        self.offer  = codec
+        self.codec  = GREGProtocol.JSON
         self.connected = False
+        self.batches = dict()
+        self.positions = collections.OrderedDict()
+        self.context = zmq.Context()
+
+        # one search thread per engine, the main thread owns the sockets
+        self.local = threading.local()
+        self.free_engines = queue.Queue()
+        for engine in engines:
+            self.free_engines.put(engine)
+        self.done = queue.Queue()
+        self.wake = self.context.socket(zmq.PULL)
+        self.wake_addr = f"inproc://done-{id(self)}"
+        self.wake.bind(self.wake_addr)
+        self.pool = concurrent.futures.ThreadPoolExecutor(len(engines), initializer=self.bind_engine)
+
+        # entries are only shared with workers that score positions the same way
+        self.cache_salt = int.from_bytes(hashlib.blake2b(f"{search}/{evaluator}/{multipv}/{multipv_depth}".encode(), digest_size=8).digest(), "big")
+
+        # without discovery the worker only searches, for benchmarks
+        if discovery is None:
+            return
+
+        self.discovery = GREGDiscovery.create(discovery)
+        if self.cache == "find":
+            self.cache = GREGCache.find(self.discovery, name)
+            self.printg(f"shared cache at {self.cache}" if self.cache else "no shared cache found", True)
         self.find_server()
 
-        # <3
-        signal.setitimer(signal.ITIMER_REAL, self.HEARTBEAT_INTERVAL_S, self.HEARTBEAT_INTERVAL_S)
-        signal.signal(signal.SIGALRM, self.send_heartbeat) 
-        
+        # <3 is sent by the main loop, searches never hold it up
         self.heartbeat_at = 0
 
 
@@ -73,36 +174,60 @@ class ChessWorker:
         '''
         param:  None
         return: None
-        Locate chess service and connect to it
+        Locate chess service and connect to it. With several servers the
+        worker's own one on the hash ring is tried first
         '''
+        service = f"{self.name}chessWorker"
         while True:
+            # look for available server, lookups are cached by the discovery
+            for item in GREGDiscovery.by_ring(self.discovery.lookup(service), f"{socket.gethostname()}:{os.getpid()}"):
+                self.printg(item)
+                if self.try_server(item["name"], item["port"]):
+                    return
 
-            # get json data from nameserver
-            conn = http.client.HTTPConnection(NSERVER)
-            conn.request("GET", "/query.json")
-            js   = json.loads(conn.getresponse().read())
+            # nothing reachable, ask the backend again after a pause
+            self.discovery.invalidate(service)
+            time.sleep(self.RETRY_DELAY)
+
+
+    def try_server(self, host, port):
+        '''
+        param:  host string:    host of the server
+        param:  port int:       worker port of the server
+        return: True if connected and False otherwise
+        '''
+        self.host = host
+        self.port = port
+        try:
+            self.socket = self.context.socket(zmq.DEALER)
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.monitor = self.socket.get_monitor_socket(zmq.EVENT_CLOSED|zmq.EVENT_HANDSHAKE_SUCCEEDED|zmq.EVENT_DISCONNECTED)
+            if self.connect():
+                self.connected = True
+                return True
+            else:
+                self.monitor.close()
+                self.socket.close()
+        except zmq.ZMQError as exc:
+            self.printg(exc)
+        return False
+
+
+    def move_server(self, host, port):
+        '''
+        param:  host string:    host of the server to move to
+        param:  port int:       its worker port
+        return: None
+        The server lent this idle worker to another server of the service,
+        connect to that one, or to any if it cannot be reached
+        '''
+        self.printg(f"moving to {host}:{port}", True)
+        self.connected = False
+        self.monitor.close()
+        self.socket.close()
+        if not self.try_server(host, port):
+            self.find_server()
 
-            # set up zmq context
-            self.context = zmq.Context()
-            
-            # look for available server
-            for item in js:
-                if "type" in item and item["type"] == f"{self.name}chessWorker":
-                    self.printg(item)
-                    self.port = item["port"]
-                    self.host = item["name"]
-                    try:
-                        self.socket = self.context.socket(zmq.DEALER)
-                        self.monitor = self.socket.get_monitor_socket(zmq.EVENT_CLOSED|zmq.EVENT_HANDSHAKE_SUCCEEDED|zmq.EVENT_DISCONNECTED)
-                        if self.connect():
-                            self.connected = True
-                            return
-                        else:
-                            self.monitor.close()
-                            self.socket.close()
-                    except zmq.ZMQError as exc:
-                        self.printg(exc)
-          
 
     def connect(self):      
         '''
@@ -113,12 +238,14 @@ class ChessWorker:
         # set up socket        
         self.socket.connect(f"tcp://{self.host}:{self.port}")
 
-        # zmq monitor magic
+        # zmq monitor magic, give up if the server never answers
+        self.monitor.setsockopt(zmq.RCVTIMEO, self.CONNECT_TIMEOUT)
         try:
             event = zmq.utils.monitor.recv_monitor_message(self.monitor) 
         except zmq.ZMQError as e:
             self.printg(e)
             return False
+        self.monitor.setsockopt(zmq.RCVTIMEO, -1)
         # if handshake didnt fail, return true
         if event['event'] == zmq.EVENT_HANDSHAKE_SUCCEEDED:
             return True
@@ -129,18 +256,31 @@ class ChessWorker:
         return False
 
 
-    def send_heartbeat(self, signum, frame):
+    def send_heartbeat(self):
         '''
-        param:  signum Signal
-        param:  frame Stackframe
-        return: None
-        Sends heartbeat to server
+        param:  None
+        return: msecs until the next heartbeat is due
+        Sends heartbeat to server when due, with the nodes searched and root
+        moves left of every batch the worker holds, the engine restarts so far
+        and the nodes/sec all engines search together, and the lookups and hits
+        of the shared cache so far
         '''
-        if self.connected and self.heartbeat_at < time.time():
-            msg = json.dumps({"type": "<3"}).encode()
+        now = time.time()
+        if self.heartbeat_at <= now:
+            # throughput while searching, kept from before if the worker was idle
+            with self.stats_lock:
+                if self.search_time > 0:
+                    self.nps = int(self.searched / self.search_time * len(self.engines))
+                self.searched = 0
+                self.search_time = 0.0
+
+            progress = [[batch['id'], batch['nodes'], batch['left']] for batch in self.batches.values()]
+            cache = [sum(client.probes for client in self.cache_clients), sum(client.hits for client in self.cache_clients)]
+            msg = GREGProtocol.encode({"type": "<3", "progress": progress, "restarts": self.restarts, "nps": self.nps, "cache": cache}, self.codec)
             self.socket.send_multipart([b"", msg])
             self.printg("sent <3")
             self.update_expiry()
+        return int((self.heartbeat_at - now) * 1000) + 1
 
         
     def update_expiry(self):
@@ -164,58 +304,109 @@ class ChessWorker:
             Scores a board. 
             Base case is depth == 1, which just returns the score of current board
             If depth > 1, then find "best" move for white, and then call solve on this list of moves, returning the score of the best one
+            Scores are looked up in and stored to the transposition table
             
         '''
-        global Engine
+        # give up between engine calls if the job was cancelled
+        self.visit()
 
         # push blacks move
         turn = board.turn
         board.push(chess.Move.from_uci(move))
 
+        # position already searched this deep
+        key = None
+        if self.table is not None and (depth > 1 or self.local.evaluator.CACHE_LEAVES):
+            key   = GREGTransposition.zobrist(board)
+            entry = self.table.probe(key)
+            if entry is not None and entry[0] >= depth and entry[3] == GREGTransposition.EXACT:
+                board.pop()
+                return -entry[1]
+
         # print to look fancy
         if pretty:
             print(board.unicode(borders=True, invert_color=True,empty_square=" ", orientation = turn))
 
+        best = None
+
         # base case
         if depth == 1:
 
-            # get score of board
+            # get score of board, a dead engine is restarted by search_move
             try:
-                analyse = Engine.analyse(board, chess.engine.Limit(depth=0))
-            except:
+                score = self.local.evaluator.evaluate([board])[0]
+            except chess.engine.EngineTerminatedError:
+                raise
+            except chess.engine.EngineError:
+                board.pop()
                 return -10000000
 
-            score = analyse["score"].pov(turn).score(mate_score=100000)
-
-            # pop from board cuz i think its passed by reference
-            board.pop()
-            return score
+            if turn == chess.BLACK:
+                score = -score
 
         # non base case
         else:
             # push whites best move
             opp_moves = [move.uci() for move in board.pseudo_legal_moves if move in board.legal_moves]
             if opp_moves == []:
-                board.pop()
-                return 10000000    
+                score = 10000000
+            else:
+                opp_move = chess.Move.from_uci(self.solve(opp_moves, board, 1, pretty)[0])
+                best = opp_move.uci()
 
-            opp_move = chess.Move.from_uci(self.solve(opp_moves, board, 1, pretty)[0])
-
-            board.push(opp_move)
+                board.push(opp_move)
               
-            # for every move in new board, see what is best
-            best_moves = [move.uci() for move in board.pseudo_legal_moves if move in board.legal_moves]
-            if best_moves == []:
-                board.pop()
+                # for every move in new board, see what is best
+                best_moves = [move.uci() for move in board.pseudo_legal_moves if move in board.legal_moves]
+                if best_moves == []:
+                    score = -10000000
+                else:
+                    score = self.solve(best_moves, board, depth-1, pretty)[1]
                 board.pop()
-                return -10000000
 
-            score = self.solve(best_moves, board, depth-1, pretty)
-            
-            # pop from board cuz passed by ref
+        # pop from board cuz passed by ref
+        board.pop()
+
+        # the table keeps the score of the side to move
+        if key is not None:
+            self.table.store(key, depth, -score, best)
+            if depth >= self.CACHE_DEPTH["solve"]:
+                self.share(key, depth, -score, best)
+        return score
+
+
+    def split_move(self, move, board, depth):
+        '''
+        param:  move string:    root move to search
+        param:  board Board:    current chess.py Board
+        param:  depth int:      depth to search the move to
+        return: tuple of (move, score, split), split is a Split message for the
+                server with the subtrees left to search, None if not split
+        Searches a root move like score_move, but only searches the first of
+        its subtrees (young brothers wait) and hands the others to the server,
+        which merges their best score into the move's
+        '''
+        self.visit()
+        board.push(chess.Move.from_uci(move))
+        opp_moves = [opp.uci() for opp in board.legal_moves]
+        if opp_moves == []:
             board.pop()
+            return self.solve([move], board, depth) + (None,)
+
+        # the greedy reply, like score_move
+        board.push(chess.Move.from_uci(self.solve(opp_moves, board, 1)[0]))
+        best_moves = [best.uci() for best in board.legal_moves]
+        top = self.top_moves(best_moves, board) if best_moves else []
+        if len(top) < 2:
             board.pop()
-            return score[1]
+            board.pop()
+            return self.solve([move], board, depth) + (None,)
+
+        score = self.score_move(top[0], board, depth - 1)
+        split = {"type":"Split", "move":move, "depth":depth - 1, "listOfMoves":top[1:], "board":board.fen()}
+        board.pop()
+        board.pop()
+        return (move, score, split)
 
 
     def solve(self, listOfMoves, board, depth, pretty=False):
@@ -229,15 +420,10 @@ class ChessWorker:
         '''
         bestMove = (None, float("-inf"))
 
-        # get scores of top level moves
-        topmoves = []
-        for move in listOfMoves:
-            score = self.score_move(move, board, 1) 
-            topmoves.append((score, move))
-
-        # only search moves that seem worth it
-        top = sorted(topmoves, reverse=True)[:5]
-        for score, move in top:
+        moves = self.top_moves(listOfMoves, board)
+        if depth >= self.CACHE_DEPTH["solve"]:
+            self.fetch_shared(board, moves, depth)
+        for move in moves:
             score = self.score_move(move, board, depth, pretty)
             if score > bestMove[1]:
                 bestMove = (move, score)
@@ -246,6 +432,593 @@ class ChessWorker:
         return bestMove
 
 
+    def top_moves(self, listOfMoves, board):
+        '''
+        param:  listOfMoves list:   moves to choose from
+        param:  board Board:        current chess.py Board
+        return: list of the moves that seem worth searching, best first
+        '''
+        # get scores of top level moves, ranked at once if the evaluator can
+        topmoves = self.rank_moves(listOfMoves, board)
+        if topmoves is None:
+            topmoves = list(zip(self.score_leaves(listOfMoves, board), listOfMoves))
+
+        # only search moves that seem worth it
+        return [move for score, move in sorted(topmoves, reverse=True)[:self.TOP_MOVES]]
+
+
+    def rank_moves(self, listOfMoves, board):
+        '''
+        param:  listOfMoves list:   moves to rank
+        param:  board Board:        current chess.py Board
+        return: list of (score, move) of the best moves, None to score every move instead
+        Pre-screen of solve as one MultiPV analysis
+        '''
+        if not self.multipv:
+            return None
+
+        self.visit()
+        try:
+            return self.local.evaluator.rank(board, listOfMoves, self.multipv, self.multipv_depth)
+        except chess.engine.EngineTerminatedError:
+            raise
+        except chess.engine.EngineError:
+            return None
+
+
+    def search_root(self, move, board, depth):
+        '''
+        param:  move string:    root move to search
+        param:  board Board:    current chess.py Board
+        param:  depth int:      depth to search the move to, like solve's
+        return: tuple of (move, score), score from the side making the move
+        Alpha-beta search of a root move, deepened one ply at a time so every
+        iteration is ordered by the best moves the previous one stored. Depth
+        counts our moves like solve does, depth d looks 2d-1 plies ahead
+        '''
+        board.push(chess.Move.from_uci(move))
+        for d in range(1, 2*depth):
+            score = -self.pvs(board, d, -self.INFINITY, self.INFINITY, 1)
+        board.pop()
+        return (move, score)
+
+
+    def pvs(self, board, depth, alpha, beta, ply):
+        '''
+        param:  board Board:    position to search
+        param:  depth int:      plies to search plus one, 1 evaluates the position
+        param:  alpha int:      score the side to move already has elsewhere
+        param:  beta int:       score the opponent already has elsewhere
+        param:  ply int:        plies from the root move
+        return: score from the side to move, within (alpha, beta) unless it failed low/high
+        Principal variation search: the first move gets the full window, the
+        others a null window and a re-search only if they beat it
+        '''
+        self.visit()
+
+        # the table gives a score or at least a move to try first
+        key   = None
+        first = None
+        table = self.table if depth > 1 or self.local.evaluator.CACHE_LEAVES else None
+        if table is not None:
+            key   = GREGTransposition.zobrist(board)
+            entry = table.probe(key)
+            if entry is not None:
+                stored_depth, score, first, bound = entry
+                if stored_depth >= depth:
+                    score = self.mate_from_table(score, ply)
+                    if bound == GREGTransposition.EXACT:
+                        return score
+                    if bound == GREGTransposition.LOWER and score >= beta:
+                        return score
+                    if bound == GREGTransposition.UPPER and score <= alpha:
+                        return score
+
+        if depth == 1:
+            score = self.local.evaluator.evaluate([board])[0]
+            score = score if board.turn == chess.WHITE else -score
+            if key is not None:
+                table.store(key, depth, self.mate_to_table(score, ply))
+            return score
+
+        moves = self.order_moves(board, first)
+        if not moves:
+            return -(GREGEvaluator.MATE_SCORE - ply) if board.is_check() else 0
+
+        # children are leaves, an evaluator that vectorizes scores them at once
+        if depth == 2 and self.local.evaluator.BATCHED:
+            scores = self.score_leaves([move.uci() for move in moves], board)
+            best   = max(range(len(moves)), key=scores.__getitem__)
+            if key is not None:
+                table.store(key, depth, self.mate_to_table(scores[best], ply), moves[best].uci())
+            return scores[best]
+
+        # children deep enough to be worth a round trip are looked up at once
+        if depth > self.CACHE_DEPTH["pvs"]:
+            self.fetch_shared(board, [move.uci() for move in moves], depth - 1)
+
+        original   = alpha
+        best_score = -self.INFINITY
+        best_move  = None
+        for i, move in enumerate(moves):
+            board.push(move)
+            if i == 0:
+                score = -self.pvs(board, depth - 1, -beta, -alpha, ply + 1)
+            else:
+                score = -self.pvs(board, depth - 1, -alpha - 1, -alpha, ply + 1)
+                if alpha < score < beta:
+                    score = -self.pvs(board, depth - 1, -beta, -score, ply + 1)
+            board.pop()
+
+            if score > best_score:
+                best_score = score
+                best_move  = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+
+        if key is not None:
+            if best_score >= beta:
+                bound = GREGTransposition.LOWER
+            elif best_score <= original:
+                bound = GREGTransposition.UPPER
+            else:
+                bound = GREGTransposition.EXACT
+            table.store(key, depth, self.mate_to_table(best_score, ply), best_move.uci(), bound)
+            if depth >= self.CACHE_DEPTH["pvs"]:
+                self.share(key, depth, self.mate_to_table(best_score, ply), best_move.uci(), bound)
+        return best_score
+
+
+    def order_moves(self, board, first=None):
+        '''
+        param:  board Board:    position to order the moves of
+        param:  first string:   move to try first, from the transposition table
+        return: list of legal moves, first move, then captures of the most
+                valuable pieces by the least valuable ones, then the rest
+        '''
+        captures = []
+        quiet    = []
+        head     = []
+        for move in board.legal_moves:
+            if first is not None and move.uci() == first:
+                head.append(move)
+            elif board.is_capture(move):
+                victim = board.piece_type_at(move.to_square) or chess.PAWN
+                captures.append((-victim, board.piece_type_at(move.from_square), move))
+            else:
+                quiet.append(move)
+        captures.sort(key=lambda capture: capture[:2])
+        return head + [capture[2] for capture in captures] + quiet
+
+
+    def mate_to_table(self, score, ply):
+        '''
+        param:  score int:  score at a node
+        param:  ply int:    plies from the root move to the node
+        return: score to store, mates counted from the node instead of the root
+        '''
+        if score > self.MATE_BOUND:
+            return score + ply
+        if score < -self.MATE_BOUND:
+            return score - ply
+        return score
+
+
+    def mate_from_table(self, score, ply):
+        '''
+        param:  score int:  score from the table
+        param:  ply int:    plies from the root move to the node
+        return: score with mates counted from the root move again
+        '''
+        if score > self.MATE_BOUND:
+            return score - ply
+        if score < -self.MATE_BOUND:
+            return score + ply
+        return score
+
+
+    def fetch_shared(self, board, moves, depth):
+        '''
+        param:  board Board:    position the moves are played in
+        param:  moves list:     moves whose positions are about to be searched
+        param:  depth int:      depth they are searched to
+        return: None
+        Looks the positions the transposition table has nothing as deep for
+        up in the shared cache, in one request, and stores what the cache has
+        in the table, where the search finds them
+        '''
+        cache = self.local.cache
+        if cache is None:
+            return
+
+        keys = []
+        for move in moves:
+            board.push_uci(move)
+            key = GREGTransposition.zobrist(board)
+            board.pop()
+            entry = self.table.probe(key)
+            if entry is None or entry[0] < depth:
+                keys.append(key)
+
+        for key, stored_depth, score, move, bound in cache.get(keys, depth):
+            self.table.store(key, stored_depth, score, move, bound)
+
+
+    def share(self, key, depth, score, move=None, bound=GREGTransposition.EXACT):
+        '''
+        param:  key int:      Zobrist key of the position
+        param:  depth int:    depth the position was searched to
+        param:  score int:    score from the side to move
+        param:  move string:  best move of the side to move, None if unknown
+        param:  bound int:    EXACT, or LOWER/UPPER if the search failed high/low
+        return: None
+        Stores a search result to the shared cache too, sent with the others
+        once the root move is searched
+        '''
+        if self.local.cache is not None:
+            self.local.cache.put(key, depth, score, move, bound)
+
+
+    def score_leaves(self, listOfMoves, board):
+        '''
+        param:  listOfMoves list:   moves to score
+        param:  board Board:        current chess.py Board
+        return: list of scores, like score_move at depth 1
+        Scores the positions after every move with one call to the evaluator,
+        leaves found in the transposition table are not evaluated again
+        '''
+        self.visit(len(listOfMoves))
+
+        turn   = board.turn
+        table  = self.table if self.local.evaluator.CACHE_LEAVES else None
+        scores = [None] * len(listOfMoves)
+        keys   = []
+        leaves = []
+        for i, move in enumerate(listOfMoves):
+            board.push(chess.Move.from_uci(move))
+            if table is not None:
+                key   = GREGTransposition.zobrist(board)
+                entry = table.probe(key)
+                if entry is not None and entry[3] == GREGTransposition.EXACT:
+                    scores[i] = -entry[1]
+                    board.pop()
+                    continue
+                keys.append(key)
+            leaves.append((i, board.copy(stack=False)))
+            board.pop()
+
+        try:
+            evaluated = self.local.evaluator.evaluate([leaf for i, leaf in leaves])
+        except chess.engine.EngineTerminatedError:
+            raise
+        except chess.engine.EngineError:
+            return [-10000000] * len(listOfMoves)
+
+        for n, (i, leaf) in enumerate(leaves):
+            score = evaluated[n] if turn == chess.WHITE else -evaluated[n]
+            if table is not None:
+                table.store(keys[n], 1, -score)
+            scores[i] = score
+        return scores
+
+
+    def bind_engine(self):
+        '''
+        param:  None
+        return: None
+        Gives a search thread its own engine and evaluator, a socket to wake
+        the main loop and a connection to the shared cache
+        '''
+        self.local.engine = self.free_engines.get()
+        self.local.evaluator = GREGEvaluator.create(self.evaluator, self.local.engine)
+        self.local.nodes = 0
+        self.local.wake = self.context.socket(zmq.PUSH)
+        self.local.wake.connect(self.wake_addr)
+
+        self.local.cache = None
+        if self.cache is not None:
+            with self.stats_lock:
+                identity = f"{socket.gethostname()}:{os.getpid()}:{len(self.cache_clients)}"
+                self.local.cache = GREGCache.CacheClient(self.context, self.cache, identity, self.cache_salt)
+                self.cache_clients.append(self.local.cache)
+
+
+    def restart_engine(self):
+        '''
+        param:  None
+        return: None
+        Replaces the dead engine of a search thread with a new one
+        '''
+        old = self.local.engine
+        try:
+            old.close()
+        except Exception:
+            pass
+
+        self.local.engine = open_engine(self.engine_options)
+        self.local.evaluator = GREGEvaluator.create(self.evaluator, self.local.engine)
+        self.engines[self.engines.index(old)] = self.local.engine
+        with self.stats_lock:
+            self.restarts += 1
+        self.printg(f"engine restarted ({self.restarts} so far)", True)
+
+
+    def search_move(self, batch, move, depth):
+        '''
+        param:  batch dict:   batch the root move belongs to
+        param:  move string:  root move to search
+        param:  depth int:    depth to search the move to
+        return: None
+        Runs on a search thread: searches one root move of a batch, like a
+        single move task, on its own copy of the board. If the engine dies the
+        move is searched again on a new one
+        '''
+        result = None
+        self.local.batch = batch
+        start = time.time()
+        nodes = self.local.nodes
+        try:
+            for attempt in range(self.ENGINE_RETRIES + 1):
+                try:
+                    board = batch['board'].copy(stack=False)
+                    if self.search == "pvs":
+                        result = self.search_root(move, board, depth)
+                    elif batch['split'] and depth >= self.SPLIT_DEPTH:
+                        result = self.split_move(move, board, depth)
+                    else:
+                        result = self.solve([move], board, depth, self.pretty)
+                    break
+                except chess.engine.EngineTerminatedError:
+                    if attempt == self.ENGINE_RETRIES:
+                        raise
+                    self.restart_engine()
+        except JobCancelled:
+            pass
+        except chess.engine.EngineError as exc:
+            self.printg(f"giving up on {move}: {exc}", True)
+        finally:
+            self.local.batch = None
+            if self.local.cache is not None:
+                self.local.cache.flush()
+            with self.stats_lock:
+                self.searched += self.local.nodes - nodes
+                self.search_time += time.time() - start
+            self.done.put((batch, move, result))
+            self.local.wake.send(b"")
+
+
+    def visit(self, nodes=1):
+        '''
+        param:  nodes int:  nodes about to be searched
+        return: None
+        Counts nodes for the thread and for the progress of the batch being
+        searched on this thread. Raises JobCancelled if the batch was cancelled
+        by the server
+        '''
+        self.local.nodes += nodes
+        batch = getattr(self.local, 'batch', None)
+        if batch is None:
+            return
+        if batch['cancelled']:
+            raise JobCancelled()
+        batch['nodes'] += nodes
+
+
+    def cancel(self, job_id=None):
+        '''
+        param:  job_id string: job whose batches are cancelled, all jobs by default
+        return: None
+        Stops the searches of the batches, their threads give up at the next
+        engine call
+        '''
+        for key in [key for key in self.batches if job_id is None or key[0] == job_id]:
+            self.batches.pop(key)['cancelled'] = True
+
+
+    def send_results(self):
+        '''
+        param:  None
+        return: None
+        Collects root moves finished by the search threads and sends the
+        result of every batch whose moves are all searched. The moves of a
+        timed batch are searched again one depth deeper while time is left
+        '''
+        while self.wake.poll(0):
+            self.wake.recv()
+
+        while True:
+            try:
+                batch, move, result = self.done.get_nowait()
+            except queue.Empty:
+                return
+
+            if batch['cancelled']:
+                continue
+
+            # subtrees of a split move go to the server before the batch's
+            # result, the move's score so far is a lower bound of its score
+            if result is not None and len(result) > 2:
+                if result[2] is not None:
+                    self.socket.send_multipart([batch['job'], GREGProtocol.encode(result[2], self.codec)])
+                result = result[:2]
+
+            if result is not None:
+                batch['partial'][move] = result
+            batch['left'] -= 1
+
+            # out of time, answer with the first result that comes in
+            if batch['expired']:
+                self.finish_batch(batch)
+                continue
+            if batch['left'] > 0:
+                continue
+
+            # every move searched to this depth, only such results are compared
+            batch['results'] = batch['partial']
+            if batch['deadline'] is not None and batch['iteration'] < batch['depth'] and time.time() < batch['deadline']:
+                batch['iteration'] += 1
+                batch['partial'] = dict()
+                batch['left'] = len(batch['moves'])
+                for move in batch['moves']:
+                    self.pool.submit(self.search_move, batch, move, batch['iteration'])
+                continue
+
+            self.finish_batch(batch)
+
+
+    def finish_batch(self, batch):
+        '''
+        param:  batch dict:   batch to answer
+        return: None
+        Sends the best root move of the deepest search every move of the
+        batch finished, searches of the batch still running are stopped
+        '''
+        del self.batches[(batch['job'], batch['id'])]
+        batch['cancelled'] = True
+
+        results = batch['results'] or batch['partial']
+        move, score = max(results.values(), key=lambda result: result[1], default=(None, -1000000))
+        if self.table is not None:
+            self.printg(self.table.stats())
+        message = GREGProtocol.encode({"type":"WorkerResult", "move":move, "score":score, "board":batch['fen'], "depth":batch['depth'], "batch":batch['id']}, self.codec)
+        self.socket.send_multipart([batch['job'], message])
+
+
+    def expire_batches(self):
+        '''
+        param:  None
+        return: msecs until the next timed batch runs out of time, None if no batch is timed
+        Answers timed batches whose time ran out with their best result so far
+        '''
+        now  = time.time()
+        wait = None
+        for batch in list(self.batches.values()):
+            if batch['deadline'] is None or batch['expired']:
+                continue
+
+            if batch['deadline'] > now:
+                left = int((batch['deadline'] - now) * 1000) + 1
+                wait = left if wait is None else min(wait, left)
+                continue
+
+            batch['expired'] = True
+            if batch['results'] or batch['partial']:
+                self.finish_batch(batch)
+        return wait
+
+
+    def recv(self):
+        '''
+        param:  None
+        return: tuple of (job id, message dict)
+        Receives a message from the server, switching to the binary framing
+        once the server uses it
+        '''
+        job_id, data = self.socket.recv_multipart()
+        if GREGProtocol.is_binary(data):
+            self.codec = GREGProtocol.BINARY
+        return job_id, GREGProtocol.decode(data)
+
+
+    def send_ready(self, status="Ready", batch_id=None):
+        '''
+        param:  status string:  Ready, or Resync when positions were lost
+        param:  batch_id int:   batch that could not be searched on a Resync
+        return: None
+        Tells the server the worker wants work, as many batches at a time as
+        it has engines plus PREFETCH more that wait for an engine here instead
+        of a round trip to the server
+        '''
+        message = {"type":"WorkerRequest", "status":status, "codec":self.offer, "slots":len(self.engines) + self.prefetch, "engines":len(self.engines)}
+        if batch_id is not None:
+            message["batch"] = batch_id
+        msg = GREGProtocol.encode(message, self.codec)
+        if self.debug:
+            print("sent readyyy")
+
+        self.socket.send_multipart([b'', msg])
+        self.update_expiry()
+
+
+    def handle_message(self, job_id, message):
+        '''
+        param:  job_id string:  job id frame of the message
+        param:  message dict:   message from the server
+        return: None
+        Hands the root moves of a task to the search threads, results are sent
+        by send_results. Cancellations of jobs that are not running are ignored
+        '''
+        if self.debug:
+            print(message)
+
+        if message.get("type") == "Cancel":
+            self.cancel(job_id)
+            self.positions.pop(job_id, None)
+            self.printg(f"job {job_id} cancelled")
+            return
+
+        # the server forgot this worker, start over
+        if message.get("type") == "Reset":
+            self.cancel()
+            self.positions.clear()
+            self.send_ready()
+            return
+
+        # binary framing sends the position once per job
+        if message.get("type") == "Position":
+            self.positions[job_id] = (chess.Board(fen=message["board"]), message["depth"])
+            if len(self.positions) > self.POSITIONS:
+                self.positions.popitem(last=False)
+            return
+
+        moves = message["listOfMoves"]
+        if "board" in message:
+            b     = message["board"]
+            depth = message["depth"]
+            board = chess.Board(fen=b)
+        elif job_id in self.positions:
+            self.positions.move_to_end(job_id)
+            board, depth = self.positions[job_id]
+            b = board.fen()
+        else:
+            # lost the position, server requeues the task and resends it
+            self.positions.clear()
+            self.send_ready("Resync", message["batch"])
+            return
+
+        # timed batches deepen the root moves from depth 1 until time runs out
+        movetime = message.get("movetime")
+        deadline = None
+        if movetime:
+            deadline = time.time() + max(movetime / 1000 - self.MOVETIME_MARGIN, 0)
+
+        # sibling root moves are searched on whichever engines are free
+        batch = {
+            'job': job_id,
+            'id': message["batch"],
+            'board': board,
+            'fen': b,
+            'depth': depth,
+            'moves': moves,
+            'iteration': 1 if deadline is not None else depth,
+            'left': len(moves),
+            'partial': dict(),
+            'results': dict(),
+            'nodes': 0,
+            'split': message.get("split", False) and deadline is None,
+            'deadline': deadline,
+            'expired': False,
+            'cancelled': False
+        }
+        self.batches[(job_id, batch['id'])] = batch
+        if self.table is not None:
+            self.table.new_search()
+        for move in moves:
+            self.pool.submit(self.search_move, batch, move, batch['iteration'])
+
+
     def get_jobs(self):
         '''
         param:  None
@@ -256,17 +1029,23 @@ class ChessWorker:
         poller = zmq.Poller()
         poller.register(self.socket, zmq.POLLIN)
         poller.register(self.monitor, zmq.POLLIN)
+        poller.register(self.wake, zmq.POLLIN)
 
-        while True:
-            # tell server 'im ready!'
-            msg = json.dumps({"type":"WorkerRequest", "status":"Ready"}).encode()
-            if self.debug:
-                print("sent readyyy")
+        # new connection, negotiate the framing again and drop old work
+        self.codec = GREGProtocol.JSON
+        self.positions.clear()
+        self.cancel()
 
-            self.socket.send_multipart([b'', msg])
-            self.update_expiry()
+        # tell server 'im ready!'
+        self.send_ready()
+        while True:
+            wait  = self.expire_batches()
+            beat  = self.send_heartbeat()
+            socks = dict(poller.poll(beat if wait is None else min(wait, beat)))
 
-            socks = dict(poller.poll())
+            # search threads finished root moves
+            if self.wake in socks and socks[self.wake] == zmq.POLLIN:
+                self.send_results()
             
             # monitor has message
             if self.monitor in socks and socks[self.monitor] == zmq.POLLIN:
@@ -276,29 +1055,18 @@ class ChessWorker:
                     self.connected = False
                     self.monitor.close()
                     self.socket.close()
-                    self.context.destroy()
                     self.find_server()
                     return
 
             # if socket has message with work
             if self.socket in socks and socks[self.socket] == zmq.POLLIN:
-                client_id, message = self.socket.recv_multipart()
-                message       = json.loads(message)
+                job_id, message = self.recv()
 
-                if self.debug:
-                    print(message)
-
-                # print board after making move
-                moves = message["listOfMoves"]
-                b     = message["board"]
-                depth = message["depth"]
-                board = chess.Board(fen=b)
-
-                s = self.solve(moves, board, depth, self.pretty)
-
-                # sending the work back to server
-                message = json.dumps({"type":"WorkerResult", "move":s[0], "score":s[1], "board":b, "depth":depth}).encode()
-                self.socket.send_multipart([client_id, message])
+                # lent to another server, get jobs from it
+                if message.get("type") == "Move":
+                    self.move_server(message["host"], message["port"])
+                    return
+                self.handle_message(job_id, message)
 
 
 # Main Execution
@@ -306,11 +1074,21 @@ def main():
     '''
     Main execution
     '''
-    global Engine
     # options
     pretty = False
     debug  = False
     name   = ""
+    codec  = GREGProtocol.BINARY
+    discovery = GREGDiscovery.DEFAULT
+    engines = 1
+    evaluator = GREGEvaluator.DEFAULT
+    table  = 16
+    search = "solve"
+    multipv = 5
+    multipv_depth = 1
+    prefetch = 1
+    options = dict()
+    cache  = None
     argind = 1
 
     # parse args
@@ -318,6 +1096,43 @@ def main():
         arg = sys.argv[argind]
         if arg == "-p":
             pretty = True
+        elif arg == "-j":
+            codec = GREGProtocol.JSON
+        elif arg == "-D":
+            argind += 1
+            discovery = sys.argv[argind]
+        elif arg == "-e":
+            argind += 1
+            engines = int(sys.argv[argind]) or os.cpu_count()
+        elif arg == "-E":
+            argind += 1
+            evaluator = sys.argv[argind]
+            if evaluator not in GREGEvaluator.EVALUATORS:
+                usage(1)
+        elif arg == "-t":
+            argind += 1
+            table = int(sys.argv[argind])
+        elif arg == "-S":
+            argind += 1
+            search = sys.argv[argind]
+            if search not in ChessWorker.SEARCHES:
+                usage(1)
+        elif arg == "-M":
+            argind += 1
+            multipv = int(sys.argv[argind])
+        elif arg == "-L":
+            argind += 1
+            multipv_depth = int(sys.argv[argind])
+        elif arg == "-P":
+            argind += 1
+            prefetch = int(sys.argv[argind])
+        elif arg == "-o":
+            argind += 1
+            option, _, value = sys.argv[argind].partition("=")
+            options[option] = engine_option(value)
+        elif arg == "-C":
+            argind += 1
+            cache = sys.argv[argind]
         elif arg == "-d":
             debug == True
         elif arg == "-n":
@@ -331,14 +1146,17 @@ def main():
         argind += 1
 
     
-    Engine  = chess.engine.SimpleEngine.popen_uci("./bin/stockfish")
+    # engines start and warm up in parallel, before the server hears of the worker
+    with concurrent.futures.ThreadPoolExecutor(engines) as pool:
+        engines = list(pool.map(lambda _: open_engine(options), range(engines)))
 
     # start doing work
-    worker = ChessWorker(pretty, debug, name)
+    worker = ChessWorker(engines, pretty, debug, name, codec, discovery, evaluator, table, search, multipv, multipv_depth, prefetch, options, cache)
     while True:
         worker.get_jobs()
     
-    Engine.close()
+    for engine in engines:
+        engine.close()
 
 if __name__ == "__main__":
     main()
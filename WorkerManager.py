@@ -17,6 +17,7 @@ def usage(status):
     print(f"Usage: python WorkerManager.py [options]")
     print(f"    -p PORT    Port to listen on")
     print(f"    -n NAME    Unique name (default=test)")
+    print(f"    -D SPEC    Discovery backend passed to workers")
     print(f"    -h         Help")
     exit(status)
 
@@ -25,6 +26,7 @@ def usage(status):
 def main():
     # variables
     name        = "test"
+    discovery   = []
     port        = 9000
     workers     = []
     doingWork   = False
@@ -39,6 +41,9 @@ def main():
         elif arg == "-n":
             argind += 1
             name = sys.argv[argind]
+        elif arg == "-D":
+            argind += 1
+            discovery = ["-D", sys.argv[argind]]
         elif arg == "-h":
             usage(0)
         else:
@@ -59,7 +64,7 @@ def main():
             print("spawning workers")
             doingWork = True
             for _ in range(int(msg["numWorkers"])):
-                w = subprocess.Popen(["python", "GREGWorker.py", "-n", name])
+                w = subprocess.Popen(["python", "GREGWorker.py", "-n", name] + discovery)
                 workers.append(w)
 
         # kill and collect workers